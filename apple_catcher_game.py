@@ -1,24 +1,39 @@
 import pygame
 import sys
 import random
+import os
+import threading
 import time
 import numpy as np
+import pylsl
+from concurrent.futures import ThreadPoolExecutor
 from constants import *
-from preprocessing import *
-from classification import *
-from data_collection import *
+from results_log import append_result
+from tracing import span, set_context, start_trace, flush_trace, stop_trace
 
 # When using the second lab screen
 
 #import os
 #os.environ['SDL_VIDEO_WINDOW_POS']="%d,%d" % (1920+960,-480)
 
+# preprocessing, classification, data_collection and session_store pull in mne and sklearn,
+# which take seconds to import. They are imported inside the methods that need them, the
+# first time on the startup threads, so the menu does not wait for them.
+
 class Apple_catcher_game:
-    def __init__(self):
-        self.subject_number = input("Enter the subject number: ")
+    def __init__(self,subject_number=None):
+        # The stream is resolved and the classifier loaded in the background while the menu is up
+        self.launch_time = time.perf_counter()
+        self.startup_times = {} # Seconds since launch at which each startup step finished
+        self.startup_threads = []
+        self.startup_errors = []
+        self.start_in_background("stream", self.init_stream)
+
+        self.subject_number = str(subject_number) if subject_number is not None else input("Enter the subject number: ")
         while self.subject_number.isdigit() == False:
             print("\nSubject number must be an integer!")
             self.subject_number = input("Enter the subject number: ")
+        self.start_in_background("classifier", self.init_classifier)
 
         # Pygame setup
         pygame.init()
@@ -31,7 +46,7 @@ class Apple_catcher_game:
         self.before_marker_time = BEFORE_MARKER_TIME
         self.marker_time = MARKER_TIME
         self.total_time = TOTAL_TIME
-        self.start_time = time.time()
+        self.start_time = time.perf_counter()
 
         # Game variables
         self.end_value = END_VALUE # Default end value of 20
@@ -42,16 +57,107 @@ class Apple_catcher_game:
         self.apple_distribution.append(-1) # To increase the length so we dont access out of bounds
         self.apple_pos = self.get_random_starting_position()
 
-        self.apple_speed = (SCREEN_HEIGHT) / (self.total_time*FPS)
-        self.load_bar_speed = SCREEN_WIDTH / (self.total_time*FPS)
         self.score = 0
         self.failures = 0
         self.right_hand = "closed"
         self.left_hand = "closed"
         self.game_mode = "training"
 
-        # Load and scale images
-        self.tree_image = pygame.image.load(TREE_IMAGE_PATH)
+        self.load_assets()
+
+        # Flags
+        self.classifier_done = False
+
+        # Timing of the last run, reported by headless.py
+        self.frame_starts = []
+        self.hand_latencies = []
+
+        # Trials are collected and classified on a worker thread so the frame loop keeps rendering
+        self.inference_executor = ThreadPoolExecutor(max_workers=1)
+        self.pending_inference = [] # (trial_index, future) pairs
+        self.trial_index = 0
+
+        # Result rows and trace spans are written on their own thread, so an fsync never holds up a frame
+        self.writer_executor = ThreadPoolExecutor(max_workers=1)
+        self.pending_writes = []
+
+        # Saving data, trials are appended to the session store as they complete
+        self.session = None
+        self.X = []
+        self.Y = []
+        self.predictions = []
+
+    def start_in_background(self, name, target):
+        # Daemon threads, so quitting from the menu never waits for a stream that is not there
+        def run():
+            try:
+                target()
+            except BaseException as e:
+                self.startup_errors.append(e)
+            self.startup_times[name] = time.perf_counter()-self.launch_time
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        self.startup_threads.append(thread)
+
+    def init_stream(self):
+        from data_collection import LSLRingBuffer, create_lsl_inlet, create_mne_info
+        from preprocessing import StreamingPreprocessor, resolve_feature_engine
+        self.inlet = create_lsl_inlet(STREAM_NAME)
+        self.inlet_info = create_mne_info(self.inlet)
+        self.offset = self.inlet.time_correction()
+        self.preprocessor = None
+        if STREAMING_PREPROCESSING:
+            self.preprocessor = StreamingPreprocessor(len(self.inlet_info['ch_names']), self.inlet_info['sfreq'])
+        self.ring_buffer = LSLRingBuffer(self.inlet, self.offset, preprocessor=self.preprocessor)
+        self.ring_buffer.start()
+        # Low channel counts use a sensor space feature engine and need no inverse operator
+        self.feature_engine = resolve_feature_engine(len(self.inlet_info['ch_names']))
+
+    def init_classifier(self):
+        self.inference_client = None
+        if INFERENCE_SERVER is not None:
+            # The server holds the classifier and source kernel, so none are loaded here
+            from inference_client import InferenceClient
+            self.inference_client = InferenceClient(INFERENCE_SERVER)
+            if not self.inference_client.load(self.subject_number):
+                print("\nNOTE: No training data available for this subject. Please select training mode to collect data.")
+            self.classifier, self.inverse_operator, self.source_kernel = None, None, None
+            return
+        from classification import AdaptiveLDA, initialize_from_training_data
+        from preprocessing import prepare_source_kernel
+        self.classifier, self.inverse_operator = initialize_from_training_data(self.subject_number)
+        if ADAPTIVE_CLASSIFIER and self.classifier is not None:
+            self.classifier = AdaptiveLDA(self.classifier)
+        self.source_kernel = None
+        if self.inverse_operator is not None:
+            self.source_kernel = prepare_source_kernel(self.inverse_operator)
+
+    def startup_ready(self):
+        return not any(thread.is_alive() for thread in self.startup_threads)
+
+    def startup_status(self):
+        if "stream" not in self.startup_times:
+            return f"Waiting for stream '{STREAM_NAME}'..."
+        if "classifier" not in self.startup_times:
+            return "Loading classifier..."
+        return ""
+
+    def wait_for_startup(self):
+        """Blocks until the stream and classifier are ready, then prints when each startup step finished."""
+        if len(self.startup_threads) == 0:
+            return
+        for thread in self.startup_threads:
+            thread.join()
+        self.startup_threads = []
+        if self.startup_errors:
+            raise self.startup_errors[0]
+        self.startup_times["ready"] = time.perf_counter()-self.launch_time
+        steps = sorted(self.startup_times.items(), key=lambda item: item[1])
+        print("Startup (s since launch): " + ", ".join(f"{name} {seconds:.2f}" for name, seconds in steps))
+   
+    def load_assets(self):
+        # Load and scale images, converted once to the display format so blits need no conversion
+        self.tree_image = pygame.image.load(TREE_IMAGE_PATH).convert_alpha()
      
         width = int(self.tree_image.get_width() * 3)
         height = int(self.tree_image.get_height() * 2)
@@ -66,27 +172,39 @@ class Apple_catcher_game:
         self.first_marker = SCREEN_WIDTH * self.before_marker_time /self.total_time
         self.second_marker= SCREEN_WIDTH * (self.before_marker_time + self.marker_time)/self.total_time
 
-        # Initialize the data stream
-        self.inlet = create_lsl_inlet(STREAM_NAME)
-        self.inlet_info = create_mne_info(self.inlet)
-        self.offset = self.inlet.time_correction()
-
-        # Flags
-        self.classifier_done = False
+        # Rendering
+        self.render_mode = RENDER_MODE
+        self.init_render_cache()
 
-        # Saving data
-        self.epochs = []
-        self.X = []
-        self.Y = []
-        self.predictions = []
-        
-        # Classifier
-        self.classifier, self.inverse_operator = initialize_from_training_data(self.subject_number)
-   
     def load_and_scale_image(self, image_path, width, height):
         image = pygame.image.load(image_path)
         image = pygame.transform.scale(image, (width, height))
-        return image
+        return image.convert_alpha()
+
+    def init_render_cache(self):
+        # Static layer: background color and the marker bars, which are redrawn over the load bar
+        self.background = pygame.Surface(self.screen.get_size()).convert()
+        self.background.fill(BACKGROUND_COLOR)
+        self.marker_rects = [
+            pygame.Rect(self.first_marker, SCREEN_HEIGHT, 2, LOAD_BAR_HEIGHT),
+            pygame.Rect(self.second_marker, SCREEN_HEIGHT, 2, LOAD_BAR_HEIGHT),
+        ]
+        for marker_rect in self.marker_rects:
+            pygame.draw.rect(self.background, MARKER_BAR_COLOR, marker_rect)
+        # The tree is its own layer since the apple falls behind it
+        self.tree_pos = (SCREEN_WIDTH/2+5-self.tree_image.get_width()/2, 0)
+        self.left_hand_pos = (self.player_pos[0] - PLAYER_WIDTH, self.player_pos[1])
+        self.right_hand_pos = (self.player_pos[0], self.player_pos[1])
+        self.hands_rect = pygame.Rect(self.left_hand_pos, (2*PLAYER_WIDTH, PLAYER_HEIGHT))
+        self.text_cache = {}
+        self.last_frame = None # What is on screen, None forces a full redraw
+
+    def render_text(self, text, color):
+        # Only rendered again when the score or failure count changes
+        key = (text, color)
+        if key not in self.text_cache:
+            self.text_cache[key] = self.font.render(text, True, color).convert_alpha()
+        return self.text_cache[key]
         
     def get_random_starting_position(self):
         side = self.apple_distribution[0]
@@ -129,35 +247,191 @@ class Apple_catcher_game:
         second_marker_rect = pygame.Rect(self.second_marker, SCREEN_HEIGHT, 2, LOAD_BAR_HEIGHT)
         pygame.draw.rect(self.screen, MARKER_BAR_COLOR, second_marker_rect)
 
+    def draw_cached(self):
+        """Redraws only the parts of the screen that changed since the last frame and
+        returns them, for pygame.display.update."""
+        # One pixel margin since the apple is blitted at its fractional position, like in draw
+        apple_rect = self.apple_image.get_rect(topleft=(self.apple_pos[0], self.apple_pos[1])).inflate(2, 2)
+        score_text = self.render_text(f'Score: {self.score}', (0, 0, 0))
+        failures_text = self.render_text(f'Failures: {self.failures}', (255, 0, 0))
+        score_rect = score_text.get_rect(topleft=(10, 10))
+        failures_rect = failures_text.get_rect(topleft=(10, 50))
+        load_bar_width = int(SCREEN_WIDTH * min(self.elapsed_time / TOTAL_TIME, 1))
+        frame = (apple_rect, self.left_hand, self.right_hand, score_rect, failures_rect, score_text, failures_text, load_bar_width)
+
+        if self.last_frame is None:
+            dirty = [self.screen.get_rect()]
+        else:
+            last_apple_rect, left_hand, right_hand, last_score_rect, last_failures_rect, last_score_text, last_failures_text, last_load_bar_width = self.last_frame
+            dirty = []
+            if apple_rect != last_apple_rect:
+                dirty += [last_apple_rect, apple_rect]
+            if (self.left_hand, self.right_hand) != (left_hand, right_hand):
+                dirty.append(self.hands_rect)
+            if score_text is not last_score_text:
+                dirty.append(score_rect.union(last_score_rect))
+            if failures_text is not last_failures_text:
+                dirty.append(failures_rect.union(last_failures_rect))
+            if load_bar_width != last_load_bar_width:
+                dirty.append(pygame.Rect(min(load_bar_width, last_load_bar_width), SCREEN_HEIGHT, abs(load_bar_width-last_load_bar_width), LOAD_BAR_HEIGHT))
+        self.last_frame = frame
+
+        # Every layer is drawn in the original order, clipped to each changed area
+        for rect in dirty:
+            self.screen.set_clip(rect)
+            self.screen.blit(self.background, rect, rect)
+            self.screen.blit(self.apple_image, (self.apple_pos[0], self.apple_pos[1]))
+            self.screen.blit(self.tree_image, self.tree_pos)
+            self.screen.blit(getattr(self, f"left_hand_{self.left_hand}"), self.left_hand_pos)
+            self.screen.blit(getattr(self, f"right_hand_{self.right_hand}"), self.right_hand_pos)
+            self.screen.blit(score_text, score_rect)
+            self.screen.blit(failures_text, failures_rect)
+            if rect.top+rect.height > SCREEN_HEIGHT:
+                self.screen.fill(LOAD_BAR_COLOR, pygame.Rect(0, SCREEN_HEIGHT, load_bar_width, LOAD_BAR_HEIGHT))
+                for marker_rect in self.marker_rects:
+                    self.screen.fill(MARKER_BAR_COLOR, marker_rect)
+        self.screen.set_clip(None)
+        return dirty
+
+    def start_clock(self):
+        """Starts the simulation clock. Apple, load bar and marker events all follow
+        sim_time, which advances in fixed steps of 1/SIMULATION_RATE seconds on the
+        perf_counter timeline, so slow frames never shift the trial timing."""
+        self.clock_origin = time.perf_counter()
+        self.lsl_clock_origin = pylsl.local_clock()
+        self.sim_steps = 0
+        self.sim_time = 0.0
+        self.elapsed_time = 0.0
+        self.start_trial_clock()
+
+    def start_trial_clock(self):
+        # The trial starts at the current simulation step, on both the perf_counter and the LSL clock
+        self.trial_start = self.sim_time
+        self.start_time = self.clock_origin+self.trial_start
+        self.lsl_start_time = self.lsl_clock_origin+self.trial_start
+
     def reset_for_next_apple(self):
         self.apple_pos = self.get_random_starting_position()
-        self.start_time = time.time()
+        self.start_trial_clock()
         self.right_hand = "closed"
         self.left_hand = "closed"
+        self.trial_index += 1
+        set_context(trial=self.trial_index)
         # Reset flags
         self.classifier_done = False
-        # Clear buffer
-        data = clear_lsl_buffer(self.inlet)
 
     def update_apple(self):
-        self.apple_pos[1] += self.apple_speed
+        self.elapsed_time = self.sim_time-self.trial_start
+        self.apple_pos[1] = SCREEN_HEIGHT*self.elapsed_time/self.total_time
 
         # Reset apple if it goes off the screen
         if self.apple_pos[1] >= SCREEN_HEIGHT+LOAD_BAR_HEIGHT:
             self.failures += 1
             self.reset_for_next_apple()
 
-    def classify(self): 
+    def step(self):
+        # Counted in whole steps so the clock does not accumulate rounding errors
+        self.sim_steps += 1
+        self.sim_time = self.sim_steps*SIMULATION_STEP
+        self.elapsed_time = self.sim_time-self.trial_start
+
+        # When sufficient time has passed after the marker event, collect data
+        if self.elapsed_time > (self.before_marker_time+self.marker_time+0.5) and (self.classifier_done == False):
+            window_end = self.lsl_start_time+self.before_marker_time+self.marker_time
+            future = self.inference_executor.submit(self.process_trial,self.trial_index,self.apple_pos[0],window_end)
+            self.pending_inference.append((self.trial_index, future))
+            self.classifier_done = True
+
+        self.check_catch()
+
+        self.update_apple()
+
+    def classify(self,prediction=None): 
         if self.game_mode == "define":
             prob = random.choice([self.apple_pos[0] / SCREEN_WIDTH, random.random(), self.apple_pos[0] / SCREEN_WIDTH])
         elif self.game_mode == "training":
             prob = self.apple_pos[0] / SCREEN_WIDTH
         else:
-            prob = self.classifier.predict(self.X[-1])
+            prob = prediction
             self.predictions.append(prob)
         return prob
+
+    def process_trial(self,trial_index,apple_position,end_time):
+        from data_collection import collect_data
+        from preprocessing import extract_features, sample_to_epoch, stream_to_epoch
+        # Runs on the inference worker, so it must not touch the game state
+        set_context(trial=trial_index, mode=self.game_mode)
+        with span("collect_data"):
+            sample,timestamps,raw_timestamps = collect_data(self.inlet, self.inlet_info,self.offset,self.ring_buffer,end_time)
+        if self.preprocessor is not None:
+            with span("stream_to_epoch"):
+                epoch = stream_to_epoch(sample,timestamps,self.inlet_info,apple_position)
+        else:
+            with span("sample_to_epoch"):
+                epoch = sample_to_epoch(sample,timestamps,self.inlet_info,apple_position)
+        sample_index = epoch.events[0,0] + np.round(epoch.times*epoch.info['sfreq']).astype(int)
+        # Stored with the LSL acquisition time of every sample, not the corrected 0-based times
+        epoch_timestamps = raw_timestamps[np.clip(sample_index,0,len(raw_timestamps)-1)]
+
+        features = None
+        prediction = None
+        if self.game_mode == "test" and self.inference_client is not None:
+            # Features, prediction and the adaptive update all happen in the server
+            with span("remote_predict"):
+                labels = epoch.events[:,-1] if ADAPTIVE_CLASSIFIER else None
+                features, prediction, _ = self.inference_client.predict(self.subject_number, epoch, labels)
+        elif self.game_mode == "test":
+            with span("extract_features"):
+                features = extract_features(epoch,self.inverse_operator,FEATURE_TMIN,FEATURE_TMAX,kernel=self.source_kernel,engine=self.feature_engine)
+            with span("predict"):
+                prediction = self.classifier.predict(features)
+            if ADAPTIVE_CLASSIFIER:
+                # The worker is the only user of the classifier, so updating it here is safe
+                with span("partial_fit"):
+                    self.classifier.partial_fit(features, epoch.events[:,-1])
+        return epoch, epoch_timestamps, features, prediction
+
+    def poll_inference(self, wait=False):
+        pending = []
+        for trial_index, future in self.pending_inference:
+            if wait or future.done():
+                self.handle_inference_result(trial_index, *future.result())
+            else:
+                pending.append((trial_index, future))
+        self.pending_inference = pending
+
+    def handle_inference_result(self,trial_index,epoch,timestamps,features,prediction):
+        # The catch deadline has passed when the apple of this trial has already left the screen
+        late = trial_index != self.trial_index
+        if late:
+            print(f"Inference for trial {trial_index} missed the catch deadline")
+            if INFERENCE_TIMEOUT_POLICY == "discard":
+                return
+
+        if self.session is None:
+            from session_store import SessionWriter
+            stem = f"{self.subject_folder()}/{self.run_id}_session"
+            from preprocessing import source_roi
+            preprocessing = "streaming" if self.preprocessor is not None else "offline"
+            # Source features are computed with a kernel of the configured roi, here or in the inference server
+            roi = source_roi() if self.feature_engine == "sloreta" else None
+            self.session = SessionWriter(stem, epoch.info, epoch.tmin, {"MI_left": 0, "MI_right": 1}, self.feature_engine, preprocessing, roi)
+        label = int(epoch.events[0,-1])
+        self.session.append_trial(epoch.get_data()[0], timestamps, label, None if prediction is None else int(prediction[0]))
+        if self.game_mode == "test":
+            self.session.append_features(features)
+            self.X.append(features)
+            self.Y.append(label)
+            # Logged per trial so a crash mid-run keeps every finished trial
+            self.pending_writes.append(self.writer_executor.submit(append_result, self.subject_number, self.run_id, trial_index, int(prediction[0]), label))
+        prob = self.classify(prediction)
+        if not late:
+            self.open_hand(prob)
+        self.pending_writes.append(self.writer_executor.submit(flush_trace))
     
     def open_hand(self,prob):
+        # Time from the end of the marker window until the hand opens
+        self.hand_latencies.append(time.perf_counter()-(self.start_time+self.before_marker_time+self.marker_time))
         if prob > 0.5:
             self.right_hand = "open"
         else:
@@ -172,26 +446,32 @@ class Apple_catcher_game:
                 self.score += 1
                 self.reset_for_next_apple()
     
+    def subject_folder(self):
+        return f"data/s{str(self.subject_number).zfill(2)}"
+
     def save_data(self):
+        if self.session is None:
+            print("No trials were recorded, nothing to save.")
+            return
+
         if self.game_mode == "training":
             print("Training mode, now computing features after game is complete.")
-            self.inverse_operator = create_inverse_operator(self.epochs[0].info)
-            for epoch in self.epochs:
-                print("\nExtracting features...\n")
-                features = extract_features(epoch,self.inverse_operator,-0.1,1.4)
-                self.X.append(features)
-      
-        # Check if the folder corresponding to the subject number exists
-        folder = f"data/s{str(self.subject_number).zfill(2)}"
-        if not os.path.exists(folder):
-            print("New subject, creating new folder")
-            os.makedirs(folder)
-
-        # Saving the epochs
-        combined_epochs = mne.concatenate_epochs(self.epochs,verbose=False)
-        combined_epochs.save(f"{folder}/{time.strftime('%Y-%m-%d_%H%M')}_epo.fif")
-        # Saving the features
-        np.save(f"{folder}/{time.strftime('%Y-%m-%d_%H%M')}_features.npy", self.X)
+            from preprocessing import create_inverse_operator, extract_features, extract_features_parallel, prepare_source_kernel
+            from session_store import SessionReader
+            # Trials are read back lazily from the session store instead of being kept in memory
+            session = SessionReader(self.session.stem)
+            if self.feature_engine == "sloreta":
+                self.inverse_operator = create_inverse_operator(session.info)
+                self.source_kernel = prepare_source_kernel(self.inverse_operator)
+                self.X = extract_features_parallel(session,self.source_kernel,FEATURE_TMIN,FEATURE_TMAX)
+            else:
+                # Sensor space features take well under a millisecond per trial, a process pool would only add overhead
+                self.X = [extract_features(session[i],None,FEATURE_TMIN,FEATURE_TMAX,engine=self.feature_engine) for i in range(len(session))]
+            for features in self.X:
+                self.session.append_features(features)
+
+        self.session.close()
+        print(f"Session saved to {self.session.stem}")
 
         
     def show_menu(self):
@@ -228,7 +508,14 @@ class Apple_catcher_game:
         end_value_txt = end_value_txt_font.render('End_Value: ', True, (0,0,0))
         end_value_txt_rect = end_value_txt.get_rect(center=(((SCREEN_WIDTH*2)/4,SCREEN_HEIGHT-55)))
 
+        # A click on start before the stream and classifier are ready starts the game once they are
+        start_requested = False
+
         while True:
+            if start_requested and self.startup_ready():
+                self.wait_for_startup()
+                return 'start'
+
             self.screen.fill(BACKGROUND_COLOR)
             self.screen.blit(self.tree_image, (SCREEN_WIDTH/2-self.tree_image.get_width()/2, 0))
             self.screen.blit(title, title_rect)
@@ -241,6 +528,9 @@ class Apple_catcher_game:
 
             self.screen.blit(end_value_txt, end_value_txt_rect)
 
+            status_text = mode_font.render(self.startup_status(), True, (128,128,128))
+            self.screen.blit(status_text, status_text.get_rect(center=(SCREEN_WIDTH / 2, SCREEN_HEIGHT / 2 + 200)))
+
             # Dessiner le champ de texte
             pygame.draw.rect(self.screen, COULEUR_CHAMP_TEXTE, input_rect)
             pygame.draw.rect(self.screen, COULEUR_BORDURE, input_rect, 2)
@@ -256,7 +546,7 @@ class Apple_catcher_game:
                 elif event.type == pygame.MOUSEBUTTONDOWN:
                     mouse_pos = pygame.mouse.get_pos()
                     if start_rect.collidepoint(mouse_pos):
-                        return 'start'
+                        start_requested = True
                     elif quit_rect.collidepoint(mouse_pos):
                         pygame.quit()
                         sys.exit()
@@ -293,59 +583,75 @@ class Apple_catcher_game:
                                 chaine_texte += event.unicode
 
             pygame.display.flip()
+            if "menu" not in self.startup_times:
+                self.startup_times["menu"] = time.perf_counter()-self.launch_time
             pygame.time.Clock().tick(FPS)
         
     
     def run(self):
+        self.wait_for_startup()
+        self.run_id = time.strftime('%Y-%m-%d_%H%M%S')
         self.apple_distribution =[1]*(self.end_value//2) + [0]*(self.end_value//2)
         random.shuffle(self.apple_distribution)
         self.apple_distribution.append(-1) # To increase the length so we dont access out of bounds
         self.apple_pos = self.get_random_starting_position()
+        self.start_clock()
+        if TRACING:
+            os.makedirs(self.subject_folder(), exist_ok=True)
+            start_trace(f"{self.subject_folder()}/{self.run_id}_trace.tsv")
+        set_context(trial=self.trial_index, mode=self.game_mode)
+        self.last_frame = None # The menu was drawn over the whole screen
 
         while (self.score + self.failures) < self.end_value:
+            self.frame_starts.append(time.perf_counter())
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
                     pygame.quit()
                     sys.exit()
 
-            self.elapsed_time = time.time()-self.start_time
-        
-            # When sufficient time has passed after the marker event, collect data
-            if self.elapsed_time > (self.before_marker_time+self.marker_time+0.5) and (self.classifier_done == False):
-                sample,timestamps = collect_data(self.inlet, self.inlet_info,self.offset)
-                epoch = sample_to_epoch(sample,timestamps,self.inlet_info,self.apple_pos[0])
-                self.epochs.append(epoch)
-
-                if self.game_mode =="test":
-                    features = extract_features(epoch,self.inverse_operator,-0.1,1.4)
-                    self.X.append(features)
-                    self.Y.append(epoch.events[0,-1])
-                    
-                prob = self.classify()
-                self.open_hand(prob)
-                self.classifier_done = True
-
-            self.check_catch()
-
-            self.update_apple()
-
-            self.draw()
-            pygame.display.flip()
+            # Open a hand as soon as the worker has classified the trial
+            self.poll_inference()
+
+            # Run every simulation step that is due, catching up after a slow frame
+            while self.sim_time+SIMULATION_STEP <= time.perf_counter()-self.clock_origin:
+                if (self.score + self.failures) >= self.end_value:
+                    break
+                self.step()
+
+            if self.render_mode == "cached":
+                with span("draw"):
+                    dirty = self.draw_cached()
+                with span("flip"):
+                    pygame.display.update(dirty)
+            else:
+                with span("draw"):
+                    self.draw()
+                with span("flip"):
+                    pygame.display.flip()
             self.clock.tick(FPS)
+
+        # Trials still being processed are kept according to INFERENCE_TIMEOUT_POLICY
+        self.poll_inference(wait=True)
+        self.inference_executor.shutdown()
+        self.writer_executor.shutdown()
+        for future in self.pending_writes:
+            future.result() # Raises any error of the writer thread
+        self.ring_buffer.stop()
+        if self.inference_client is not None:
+            self.inference_client.close()
         
         if self.game_mode == "test":
-            save_results(self.predictions, self.Y,self.subject_number)
+            from classification import print_results
             print_results(self.predictions, self.Y)
 
-        self.save_data() 
+        self.save_data()
+        stop_trace() 
     
         pygame.quit()
-        sys.exit()
 
 if __name__ == "__main__":
     game = Apple_catcher_game()
     print("\nGame started!\n")
 
     if game.show_menu()=='start':
-        game.start_time=time.time()
         game.run()
\ No newline at end of file
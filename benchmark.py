@@ -0,0 +1,312 @@
+import argparse
+import json
+import os
+import time
+import numpy as np
+import mne
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.model_selection import RepeatedStratifiedKFold
+from constants import *
+from preprocessing import *
+from classification import AdaptiveLDA, make_classifier
+from giga_batch import add_giga_arguments, giga_options, load_giga_features
+from results_log import compute_metrics
+
+def make_info(n_channels, sfreq):
+    info = mne.create_info(ch_names=CH_NAMES_BY_COUNT[n_channels], sfreq=sfreq, ch_types='eeg')
+    info.set_montage(mne.channels.make_standard_montage('standard_1020'))
+    return info
+
+def print_timings(name, timings):
+    timings = np.array(timings)*1000
+    print(f"{name:<35}{np.median(timings):>10.3f} ms (median){np.percentile(timings,95):>10.3f} ms (p95)")
+
+def bench_preprocessing(args):
+    """Per-trial filtering with sample_to_epoch against the streaming preprocessor."""
+    info = make_info(args.channels, args.sfreq)
+    n_samples = int(SAMPLE_WINDOW*args.sfreq)
+    chunk_samples = max(int(0.05*args.sfreq), 1)
+    rng = np.random.default_rng(0)
+
+    per_trial, per_chunk, finalize = [], [], []
+    for _ in range(args.trials):
+        sample = rng.standard_normal((args.channels, n_samples))*1e-5
+        timestamps = np.arange(n_samples)/args.sfreq
+
+        start = time.perf_counter()
+        sample_to_epoch(sample, timestamps, info, 0)
+        per_trial.append(time.perf_counter()-start)
+
+        preprocessor = StreamingPreprocessor(args.channels, args.sfreq)
+        processed = []
+        for i in range(0, n_samples, chunk_samples):
+            start = time.perf_counter()
+            processed.append(preprocessor.process(sample[:, i:i+chunk_samples]))
+            per_chunk.append(time.perf_counter()-start)
+        processed = np.concatenate(processed, axis=1)
+
+        start = time.perf_counter()
+        stream_to_epoch(processed, timestamps, info, 0)
+        finalize.append(time.perf_counter()-start)
+
+    print(f"\n{args.channels} channels at {args.sfreq} Hz, {args.trials} trials\n")
+    print_timings("sample_to_epoch", per_trial)
+    print_timings(f"streaming, per {chunk_samples} sample chunk", per_chunk)
+    print_timings("stream_to_epoch (finalize)", finalize)
+
+def make_sphere_inverse(info):
+    """Free orientation volume inverse operator on a sphere head model, for machines without fsaverage."""
+    sphere = mne.make_sphere_model('auto', 'auto', info, verbose=False)
+    src = mne.setup_volume_source_space(sphere=sphere, pos=15., verbose=False)
+    fwd = mne.make_forward_solution(info, None, src, sphere, meg=False, verbose=False)
+    return mne.minimum_norm.make_inverse_operator(info, fwd, mne.make_ad_hoc_cov(info, verbose=False), loose=1, verbose=False)
+
+def bench_features(args):
+    """Source band power from the imaging kernel against source_reconstruction, and
+    extract_features_parallel against serial extract_features, on the same epochs."""
+    info = make_info(args.channels, args.sfreq)
+    n_samples = int(SAMPLE_WINDOW*args.sfreq)
+    rng = np.random.default_rng(0)
+    epochs = mne.EpochsArray(rng.standard_normal((args.trials, args.channels, n_samples))*1e-5, info, tmin=-round(BEFORE_MARKER_TIME*args.sfreq)/args.sfreq, verbose=False)
+    epochs.set_eeg_reference('average', projection=True, verbose=False)
+    if args.sphere:
+        inverse_operator, ori = make_sphere_inverse(epochs.info), None
+    else:
+        inverse_operator, ori = create_inverse_operator(epochs.info), 'normal'
+    kernel = prepare_source_kernel(inverse_operator, method='sLORETA', snr=3.0, ori=ori, roi=None)
+    X = extract_features(epochs, None, FEATURE_TMIN, FEATURE_TMAX, kernel=kernel)
+
+    filter_times, kernel_times, stc_times = [], [], []
+    X_stc = []
+    for i in range(args.trials):
+        start = time.perf_counter()
+        band_data = filter_bank_epochs(epochs.get_data()[i:i+1], epochs.times, args.sfreq, FEATURE_TMIN, FEATURE_TMAX)
+        filter_times.append(time.perf_counter()-start)
+
+        start = time.perf_counter()
+        np.concatenate([source_band_power(kernel, x) for x in band_data], axis=1)
+        kernel_times.append(time.perf_counter()-start)
+
+        start = time.perf_counter()
+        x_stc = []
+        for x in band_data:
+            stcs = source_reconstruction(mne.EpochsArray(x, epochs.info, verbose=False), inverse_operator, method='sLORETA', snr=3.0, ori=ori)
+            x_stc.append(np.array([np.mean(np.abs(stc.data)**2, axis=1) for stc in stcs]))
+        stc_times.append(time.perf_counter()-start)
+        X_stc.append(np.concatenate(x_stc, axis=1))
+    X_stc = np.concatenate(X_stc)
+
+    print(f"\n{args.channels} channels at {args.sfreq} Hz, {args.trials} trials, {X.shape[1]} features\n")
+    print_timings("filter bank, per trial", filter_times)
+    print_timings("source_band_power, per trial", kernel_times)
+    print_timings("source_reconstruction, per trial", stc_times)
+    print(f"\nKernel speedup {np.median(stc_times)/np.median(kernel_times):.1f}x, max relative difference {np.max(np.abs(X-X_stc)/np.abs(X_stc)):.2e}")
+    assert np.allclose(X, X_stc, rtol=1e-7, atol=0), "Kernel features differ from source_reconstruction"
+
+    # Two sessions, the way initialize_from_training_data extracts them
+    sessions = [epochs[:args.trials//2], epochs[args.trials//2:]]
+    serial = [extract_features(session, None, FEATURE_TMIN, FEATURE_TMAX, kernel=kernel) for session in sessions]
+    parallel = extract_features_parallel(sessions, kernel, FEATURE_TMIN, FEATURE_TMAX, n_jobs=args.jobs)
+    assert all(np.array_equal(a, b) for a, b in zip(serial, parallel)), "extract_features_parallel differs from extract_features"
+    print("extract_features_parallel is identical to extract_features")
+
+def make_drifting_features(n_trials, n_features, separation, drift, rng, n_sources=10):
+    """Two class feature vectors mixed from a few latent sources, like the strongly
+    correlated source powers, whose class means drift over the session."""
+    y = rng.permutation(np.arange(n_trials) % 2)
+    direction = rng.standard_normal(n_sources)
+    direction /= np.linalg.norm(direction)
+    drift_direction = rng.standard_normal(n_sources)
+    drift_direction /= np.linalg.norm(drift_direction)
+    latent = rng.standard_normal((n_trials, n_sources)) + np.outer(y-0.5, direction)*separation
+    latent += np.outer(np.linspace(0, drift, n_trials), drift_direction)
+    mixing = rng.standard_normal((n_sources, n_features))
+    return latent @ mixing + 0.1*rng.standard_normal((n_trials, n_features)), y
+
+def bench_adaptive(args):
+    """Frozen, fully refitted and adaptive classifiers on drifting synthetic features."""
+    rng = np.random.default_rng(0)
+    X, y = make_drifting_features(args.initial+args.trials, args.features, args.separation, args.drift, rng)
+    X_init, y_init = X[:args.initial], y[:args.initial]
+
+    frozen = make_classifier().fit(X_init, y_init)
+    adaptive = AdaptiveLDA(make_classifier().fit(X_init, y_init))
+
+    correct = {"frozen": 0, "full refit": 0, "adaptive": 0}
+    update_times = {"full refit": [], "adaptive": []}
+    refit = frozen
+    for i in range(args.initial, len(y)):
+        x = X[i:i+1]
+        correct["frozen"] += frozen.predict(x)[0] == y[i]
+        correct["full refit"] += refit.predict(x)[0] == y[i]
+        correct["adaptive"] += adaptive.predict(x)[0] == y[i]
+
+        start = time.perf_counter()
+        refit = make_classifier().fit(X[:i+1], y[:i+1])
+        update_times["full refit"].append(time.perf_counter()-start)
+
+        start = time.perf_counter()
+        adaptive.partial_fit(x, y[i:i+1])
+        update_times["adaptive"].append(time.perf_counter()-start)
+
+    print(f"\n{args.features} features, {args.initial} training trials, {args.trials} online trials\n")
+    for name in correct:
+        print(f"{name:<15}accuracy {correct[name]/args.trials:.2%}")
+    print()
+    for name, timings in update_times.items():
+        print_timings(f"{name} update", timings)
+
+def bench_render(args):
+    """Frame draw and display update time of the full and cached render modes."""
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    import pygame
+    from apple_catcher_game import Apple_catcher_game
+
+    # Only the display part of the game is set up, there is no stream or classifier
+    pygame.init()
+    game = Apple_catcher_game.__new__(Apple_catcher_game)
+    game.screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT + LOAD_BAR_HEIGHT))
+    game.font = pygame.font.SysFont(None, 36)
+    game.before_marker_time, game.marker_time, game.total_time = BEFORE_MARKER_TIME, MARKER_TIME, TOTAL_TIME
+    game.player_pos = [SCREEN_WIDTH//2, SCREEN_HEIGHT - PLAYER_HEIGHT]
+    game.load_assets()
+
+    frames_per_trial = int(TOTAL_TIME*FPS)
+    for render_mode in ("full", "cached"):
+        game.last_frame = None
+        game.score, game.failures = 0, 0
+        timings = []
+        for frame in range(args.frames):
+            trial, step = divmod(frame, frames_per_trial)
+            game.elapsed_time = step/FPS
+            side = trial % 2
+            game.apple_pos = [game.player_pos[0]+PLAYER_WIDTH//2-10 if side else game.player_pos[0]-APPLE_SIZE-PLAYER_WIDTH//2, SCREEN_HEIGHT*step/frames_per_trial]
+            opened = "open" if game.elapsed_time > BEFORE_MARKER_TIME+MARKER_TIME else "closed"
+            game.right_hand, game.left_hand = (opened, "closed") if side else ("closed", opened)
+            game.score = trial
+
+            start = time.perf_counter()
+            if render_mode == "cached":
+                pygame.display.update(game.draw_cached())
+            else:
+                game.draw()
+                pygame.display.flip()
+            timings.append(time.perf_counter()-start)
+        print_timings(f"{render_mode} render, frame", timings)
+    print(f"\nFrame budget at {FPS} FPS: {1000/FPS:.1f} ms")
+    pygame.quit()
+
+def _giga_labels(subject_number, feature_args, options):
+    # Computes and caches the subject's features, only the labels are sent back
+    _, y = load_giga_features(subject_number, *feature_args, **options)
+    return np.asarray(y)
+
+def _giga_fold(subject_number, fold, train, test, feature_args, options):
+    X, y = load_giga_features(subject_number, *feature_args, **options)
+    clf = make_classifier()
+    start = time.perf_counter()
+    clf.fit(X[train], y[train])
+    fit_time = time.perf_counter()-start
+
+    # Trials are predicted one at a time, the way the game does it
+    latencies = []
+    predictions = []
+    for i in test:
+        start = time.perf_counter()
+        predictions.append(clf.predict(X[i:i+1])[0])
+        latencies.append(time.perf_counter()-start)
+    metrics = compute_metrics(predictions, y[test])
+    metrics["fit_ms"] = fit_time*1000
+    metrics["predict_ms"] = float(np.median(latencies))*1000
+    metrics["n_features"] = X.shape[1]
+    return subject_number, fold, metrics
+
+def bench_giga_cv(args):
+    """Repeated stratified k-fold accuracy, recall, fit time and predict latency of the classifier on every GIGA subject."""
+    options = giga_options(args)
+    feature_args = (args.tmin, args.tmax, args.decimation, F_BANDS, args.roi, args.roi_mode)
+    cv = RepeatedStratifiedKFold(n_splits=args.folds, n_repeats=args.repeats, random_state=42)
+
+    results = {}
+    with ProcessPoolExecutor(args.jobs) as executor:
+        # Features first, one subject per worker, then every fold of every subject
+        labels = {}
+        futures = {subject_number: executor.submit(_giga_labels, subject_number, feature_args, options) for subject_number in args.subjects}
+        for subject_number, future in futures.items():
+            try:
+                labels[subject_number] = future.result()
+            except Exception as e:
+                print(f"Subject {subject_number} failed: {e}")
+
+        futures = [
+            executor.submit(_giga_fold, subject_number, fold, train, test, feature_args, options)
+            for subject_number, y in labels.items()
+            for fold, (train, test) in enumerate(cv.split(np.zeros(len(y)), y))
+        ]
+        for future in futures:
+            subject_number, fold, metrics = future.result()
+            results.setdefault(subject_number, []).append(metrics)
+
+    columns = ["accuracy", "right_recall", "left_recall", "fit_ms", "predict_ms", "n_features"]
+    summary = {
+        subject_number: {column: float(np.mean([m[column] for m in folds])) for column in columns} | {"accuracy_std": float(np.std([m["accuracy"] for m in folds]))}
+        for subject_number, folds in sorted(results.items())
+    }
+    roi = f", sources in {args.roi} ({args.roi_mode})" if args.roi is not None else ""
+    print(f"\n{args.folds}-fold CV x {args.repeats}, features from {args.tmin} to {args.tmax} s{roi}\n")
+    print(f"{'subject':<10}{'accuracy':>16}{'right_rec':>11}{'left_rec':>10}{'fit ms':>10}{'predict ms':>12}{'features':>10}")
+    for subject_number, row in summary.items():
+        print(f"{subject_number:<10}{row['accuracy']:>9.2%} ±{row['accuracy_std']:>5.2%}{row['right_recall']:>11.2%}{row['left_recall']:>10.2%}{row['fit_ms']:>10.1f}{row['predict_ms']:>12.3f}{row['n_features']:>10.0f}")
+    if summary:
+        mean = {column: float(np.mean([row[column] for row in summary.values()])) for column in columns}
+        print(f"{'mean':<10}{mean['accuracy']:>9.2%}{'':>7}{mean['right_recall']:>11.2%}{mean['left_recall']:>10.2%}{mean['fit_ms']:>10.1f}{mean['predict_ms']:>12.3f}{mean['n_features']:>10.0f}")
+
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump({"args": vars(args) | {"func": None}, "subjects": summary, "folds": results}, file, indent=4)
+        print(f"Report written to {args.output}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the online decoding pipeline")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    preprocessing_parser = subparsers.add_parser("preprocessing", help=bench_preprocessing.__doc__)
+    preprocessing_parser.add_argument("--channels", type=int, default=32, choices=sorted(CH_NAMES_BY_COUNT))
+    preprocessing_parser.add_argument("--sfreq", type=float, default=250.)
+    preprocessing_parser.add_argument("--trials", type=int, default=20)
+    preprocessing_parser.set_defaults(func=bench_preprocessing)
+
+    features_parser = subparsers.add_parser("features", help=bench_features.__doc__)
+    features_parser.add_argument("--channels", type=int, default=32, choices=sorted(CH_NAMES_BY_COUNT))
+    features_parser.add_argument("--sfreq", type=float, default=250.)
+    features_parser.add_argument("--trials", type=int, default=20)
+    features_parser.add_argument("--jobs", type=int, default=2)
+    features_parser.add_argument("--sphere", action="store_true", help="Use a sphere head model instead of fsaverage")
+    features_parser.set_defaults(func=bench_features)
+
+    adaptive_parser = subparsers.add_parser("adaptive", help=bench_adaptive.__doc__)
+    adaptive_parser.add_argument("--features", type=int, default=2000)
+    adaptive_parser.add_argument("--initial", type=int, default=40)
+    adaptive_parser.add_argument("--trials", type=int, default=200)
+    adaptive_parser.add_argument("--separation", type=float, default=2.0)
+    adaptive_parser.add_argument("--drift", type=float, default=4.0)
+    adaptive_parser.set_defaults(func=bench_adaptive)
+
+    render_parser = subparsers.add_parser("render", help=bench_render.__doc__)
+    render_parser.add_argument("--frames", type=int, default=1000)
+    render_parser.set_defaults(func=bench_render)
+
+    giga_parser = subparsers.add_parser("giga-cv", help=bench_giga_cv.__doc__)
+    add_giga_arguments(giga_parser)
+    giga_parser.add_argument("--folds", type=int, default=5)
+    giga_parser.add_argument("--repeats", type=int, default=2)
+    giga_parser.add_argument("--tmin", type=float, default=FEATURE_TMIN)
+    giga_parser.add_argument("--tmax", type=float, default=FEATURE_TMAX)
+    giga_parser.add_argument("--decimation", type=int, default=1)
+    giga_parser.add_argument("--roi", nargs="+", default=SOURCE_ROI, help=f"Labels of the {ROI_PARCELLATION} parcellation to limit the sources to")
+    giga_parser.add_argument("--roi-mode", choices=["mean", "restrict"], default=SOURCE_ROI_MODE)
+    giga_parser.add_argument("--output", default=None, help="Write the per-subject and per-fold results as JSON to this file")
+    giga_parser.set_defaults(func=bench_giga_cv)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,83 @@
+import glob
+import hashlib
+import os
+import shutil
+import sys
+import numpy as np
+from constants import *
+
+def hash_key(*parts) -> str:
+    """Content-addressed key for a sequence of strings, numbers and arrays."""
+    h = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            h.update(str(part.dtype).encode())
+            h.update(str(part.shape).encode())
+            h.update(np.ascontiguousarray(part).tobytes())
+        else:
+            h.update(repr(part).encode())
+        h.update(b"|")
+    return h.hexdigest()
+
+def cache_path(folder, key, suffix):
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, f"{key}{suffix}")
+
+def cache_lookup(folder, key, suffix):
+    """Returns the path of a cached entry and marks it as recently used, or None."""
+    path = os.path.join(folder, f"{key}{suffix}")
+    if not os.path.exists(path):
+        return None
+    os.utime(path)
+    return path
+
+def cache_size(folder):
+    total = 0
+    for root, _, files in os.walk(folder):
+        for f in files:
+            try:
+                total += os.path.getsize(os.path.join(root, f))
+            except FileNotFoundError:
+                pass
+    return total
+
+def evict_cache(folder, max_bytes):
+    """Deletes least recently used entries until the folder fits in max_bytes. Several
+    processes may evict and write the same folder at once, so entries can disappear at
+    any point, and files another process is still writing are left alone."""
+    entries = []
+    for f in glob.glob(f"{folder}/*"):
+        if ".tmp" in os.path.basename(f) or not os.path.isfile(f):
+            continue
+        try:
+            stat = os.stat(f)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, f))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    for _, size, f in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(f)
+        except FileNotFoundError:
+            pass # Evicted by another process
+        total -= size
+
+def clear_cache(folder=CACHE_DIR):
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+        print(f"Removed cache folder {folder}")
+
+if __name__ == "__main__":
+    # Usage: python cache.py clear [subfolder]
+    #        python cache.py size [subfolder]
+    command = sys.argv[1] if len(sys.argv) > 1 else "size"
+    folder = os.path.join(CACHE_DIR, sys.argv[2]) if len(sys.argv) > 2 else CACHE_DIR
+    if command == "clear":
+        clear_cache(folder)
+    elif command == "size":
+        print(f"{folder}: {cache_size(folder)/1e6:.1f} MB")
+    else:
+        print(f"Unknown command: {command}")
@@ -4,75 +4,279 @@ import numpy as np
 import glob
 import json
 import os
-from sklearn.metrics import accuracy_score, recall_score, precision_score, f1_score, confusion_matrix
+import time
+import joblib
+from sklearn.base import BaseEstimator, TransformerMixin
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
 from sklearn.model_selection import train_test_split
 from sklearn.decomposition import PCA
 from sklearn.pipeline import make_pipeline
 from sklearn.preprocessing import StandardScaler
-from preprocessing import create_inverse_operator
+from preprocessing import create_inverse_operator, extract_features, prepare_source_kernel, project_source_features, resolve_feature_engine, source_roi
+from cache import hash_key
+from session_store import SessionReader
 
 
 from constants import *
 
 def check_for_existing_training_data(subject_number):
     folder = f"data/s{subject_number}"
-    if len(glob.glob(f"{folder}/*.fif")) == 0:
+    if len(glob.glob(f"{folder}/*_session_meta.json")) > 0:
+        return True
+    if len(glob.glob(f"{folder}/*_epo.fif")) == 0:
         return False
-    if len(glob.glob(f"{folder}/*.npy")) == 0:
+    if len(glob.glob(f"{folder}/*_features.npy")) == 0:
         return False
     return True
 
 
+class FilterBankCSP(BaseEstimator, TransformerMixin):
+    """Common spatial patterns per band on the covariance features of the "csp" engine.
+    Each band's covariances are projected on the filters that best separate the two
+    classes and reduced to the log-variance of every filter."""
+
+    def __init__(self, n_bands=len(F_BANDS), n_components=CSP_COMPONENTS, tolerance=1e-10):
+        self.n_bands = n_bands
+        self.n_components = n_components
+        self.tolerance = tolerance
+
+    def covariances(self, X):
+        X = np.asarray(X).reshape(len(X), self.n_bands, -1)
+        n_channels = int((np.sqrt(8*X.shape[2]+1)-1)/2)
+        rows, cols = np.triu_indices(n_channels)
+        C = np.zeros((len(X), self.n_bands, n_channels, n_channels))
+        C[..., rows, cols] = X
+        C[..., cols, rows] = X
+        return C
+
+    def fit(self, X, y):
+        C = self.covariances(X)
+        self.classes_ = np.unique(y)
+        self.filters_ = []
+        for band in range(self.n_bands):
+            C_a = C[y == self.classes_[0], band].mean(axis=0)
+            C_b = C[y == self.classes_[1], band].mean(axis=0)
+            # The average reference puts the common mode in the null space of every covariance.
+            # Whitening with the non-null eigenvectors of C_a+C_b only keeps the filters out of it
+            values, vectors = np.linalg.eigh(C_a + C_b)
+            keep = values > self.tolerance*values.max()
+            whitening = vectors[:, keep]/np.sqrt(values[keep])
+            _, rotation = np.linalg.eigh(whitening.T @ C_a @ whitening)
+            W = whitening @ rotation
+            # Filters sorted by the variance ratio of the first class, taken from both ends
+            rank = W.shape[1]
+            n_components = min(self.n_components, rank)
+            half = n_components//2
+            self.filters_.append(W[:, list(range(half)) + list(range(rank-(n_components-half), rank))])
+        return self
+
+    def transform(self, X):
+        C = self.covariances(X)
+        features = []
+        for band, W in enumerate(self.filters_):
+            variance = np.einsum('ck,nce,ek->nk', W, C[:, band], W)
+            # Floored relative to the total power, so rounding noise never reaches the log
+            total = np.trace(C[:, band], axis1=1, axis2=2)[:, None]
+            features.append(np.log(np.maximum(variance, self.tolerance*total)))
+        return np.concatenate(features, axis=1)
+
+def make_classifier(engine="sloreta"):
+    # The within-class covariance is stored so AdaptiveLDA can continue from it
+    if engine == "csp":
+        return make_pipeline(FilterBankCSP(),StandardScaler(),LinearDiscriminantAnalysis(store_covariance=True))
+    if engine == "logvar":
+        return make_pipeline(StandardScaler(),LinearDiscriminantAnalysis(store_covariance=True))
+    return make_pipeline(StandardScaler(),PCA(n_components=0.95),LinearDiscriminantAnalysis(store_covariance=True))
+
+class AdaptiveLDA:
+    """Keeps adapting the LDA step of a fitted make_classifier pipeline to labeled
+    trials during a session. Class means and the shared covariance are updated with
+    exponential forgetting, and the inverse covariance with a Sherman-Morrison
+    rank-one update, so each trial costs O(k^2) in the number of PCA components
+    regardless of how many trials came before. The scaler and PCA projection stay
+    fixed, since moving them would invalidate the statistics kept in their space."""
+
+    def __init__(self, pipeline, rate=ADAPTATION_RATE, covariance_rate=ADAPTATION_RATE_COVARIANCE):
+        self.pipeline = pipeline
+        self.projection = pipeline[:-1]
+        lda = pipeline[-1]
+        self.classes_ = lda.classes_
+        self.means = lda.means_.copy()
+        self.priors = lda.priors_.copy()
+        covariance = lda.covariance_
+        regularization = 1e-6*np.trace(covariance)/len(covariance)
+        self.precision = np.linalg.inv(covariance + regularization*np.eye(len(covariance)))
+        self.rate = rate
+        self.covariance_rate = covariance_rate
+        self.update_weights()
+
+    def update_weights(self):
+        self.coef = self.precision @ (self.means[1]-self.means[0])
+        self.intercept = -0.5*(self.means[1]+self.means[0]) @ self.coef + np.log(self.priors[1]/self.priors[0])
+
+    def decision_function(self, X):
+        return self.projection.transform(X) @ self.coef + self.intercept
+
+    def predict(self, X):
+        return self.classes_[(self.decision_function(X) > 0).astype(int)]
+
+    def predict_proba(self, X):
+        prob = 1/(1+np.exp(-self.decision_function(X)))
+        return np.column_stack([1-prob, prob])
+
+    def partial_fit(self, X, y):
+        rate = self.covariance_rate
+        for z, label in zip(self.projection.transform(X), y):
+            c = np.searchsorted(self.classes_, label)
+            residual = z-self.means[c]
+            self.means[c] += self.rate*residual
+
+            # (1-rate)*cov + rate*u*u^T, inverted in place of the covariance itself
+            p_u = self.precision @ residual
+            b = rate/(1-rate)
+            self.precision = (self.precision - b*np.outer(p_u, p_u)/(1+b*(residual @ p_u)))/(1-rate)
+        self.update_weights()
+        return self
+
+def training_data_fingerprint(files, ch_names, engine="sloreta"):
+    """Changes whenever a session is added or replaced, or the feature config, classifier or channel set changes."""
+    # The modification time catches a session recorded again with the same number of trials
+    file_stats = [(os.path.basename(f), os.stat(f).st_size, os.stat(f).st_mtime_ns) for f in files]
+    roi = source_roi() if engine == "sloreta" else None
+    return hash_key(file_stats, F_BANDS, FEATURE_TMIN, FEATURE_TMAX, engine, roi, PREPROCESSING_MODE, ch_names, repr(make_classifier(engine)))
+
+def save_classifier(folder, clf, metadata):
+    # Write to temporary files first so an interrupted save never leaves a half written model
+    joblib.dump(clf, f"{folder}/classifier.joblib.tmp")
+    with open(f"{folder}/classifier.json.tmp", "w") as file:
+        json.dump(metadata, file, indent=4)
+    os.replace(f"{folder}/classifier.joblib.tmp", f"{folder}/classifier.joblib")
+    os.replace(f"{folder}/classifier.json.tmp", f"{folder}/classifier.json")
+
+def load_classifier(folder, fingerprint):
+    """Returns the stored classifier if it was trained on the same data and config, else None."""
+    try:
+        with open(f"{folder}/classifier.json", "r") as file:
+            metadata = json.load(file)
+    except (OSError, json.JSONDecodeError):
+        return None
+    if metadata.get("fingerprint") != fingerprint:
+        return None
+    return joblib.load(f"{folder}/classifier.joblib")
+
+def stored_features(features, features_engine, features_roi, load_epochs, engine, kernel):
+    """Stored features in the form the current engine and source ROI expect. They are
+    recomputed from the epochs returned by load_epochs when they were stored for
+    another engine or ROI, or not at all. features_roi None means every source."""
+    if features is not None and features_engine == engine:
+        features = np.asarray(features).reshape(len(features), -1)
+        if engine == "sloreta":
+            features = project_source_features(features, kernel, len(F_BANDS), features_roi)
+        if features is not None:
+            return features
+    print(f"Recomputing features for the {engine} engine")
+    return extract_features(load_epochs(), None, FEATURE_TMIN, FEATURE_TMAX, kernel=kernel, engine=engine)
+
 def initialize_from_training_data(subject_number):
     folder = f"data/s{str(subject_number).zfill(2)}"
-    epochs_all = []
     y_all = []
     X_all = []
 
-    # Get the sorted lists of .fif and .npy files
-    fif_files = sorted(glob.glob(f"{folder}/*.fif"))
-    npy_files = sorted(glob.glob(f"{folder}/*.npy"))
+    # Pair the .fif and .npy files written by older versions of the game by their time stamp.
+    # Those versions always filtered offline
+    fif_files = []
+    npy_files = []
+    legacy_files = sorted(glob.glob(f"{folder}/*_epo.fif")) if PREPROCESSING_MODE == "offline" else []
+    for fif_file in legacy_files:
+        npy_file = fif_file[:-len("_epo.fif")] + "_features.npy"
+        if not os.path.exists(npy_file):
+            print(f"Skipping {fif_file}, no matching {npy_file}")
+            continue
+        fif_files.append(fif_file)
+        npy_files.append(npy_file)
 
-    # Check if both lists have the same length
-    if len(fif_files) != len(npy_files):
-        print("Mismatch in the number of .fif and .npy files.")
-        return None,None
+    # Session stores, skipping sessions that ended before any trial was stored
+    sessions = []
+    for meta_file in sorted(glob.glob(f"{folder}/*_session_meta.json")):
+        session = SessionReader(meta_file)
+        preprocessing = session.meta.get("preprocessing", "offline")
+        if len(session) == 0:
+            print(f"Skipping {session.stem}, it has no trials")
+        elif preprocessing != PREPROCESSING_MODE:
+            # Its trials were filtered differently, so its features would not match live ones
+            print(f"Skipping {session.stem}, it was recorded with {preprocessing} preprocessing")
+        else:
+            sessions.append(session)
     
-    if len(fif_files) == 0:
+    if len(fif_files) == 0 and len(sessions) == 0:
         print("\nNOTE: No training data available for this subject. Please select training mode to collect data.")
         return None,None
 
+    # The measurement info is all the inverse operator needs, so only the header is read
+    info = mne.io.read_info(fif_files[0], verbose=False) if fif_files else sessions[0].info
+    engine = resolve_feature_engine(len(info['ch_names']))
+    print(f"Feature engine: {engine}")
+    data_files = fif_files+npy_files+[f for session in sessions for f in session.data_files()]
+    fingerprint = training_data_fingerprint(data_files, info['ch_names'], engine)
+    clf = load_classifier(folder, fingerprint)
+    inverse_operator = None
+    if clf is not None:
+        print(f"Loaded stored classifier from {folder}/classifier.joblib")
+        if engine == "sloreta":
+            print("Creating inverse operator from training data")
+            inverse_operator = create_inverse_operator(info)
+        return clf, inverse_operator
+
+    # Sensor space engines skip the inverse operator entirely
+    kernel = None
+    if engine == "sloreta":
+        print("Creating inverse operator from training data")
+        inverse_operator = create_inverse_operator(info)
+        kernel = prepare_source_kernel(inverse_operator)
+
     for fif_file, npy_file in zip(fif_files, npy_files):
         print(f"Loading {fif_file} and {npy_file}")
 
-        # Load epochs from .fif file
-        epochs = mne.read_epochs(fif_file, preload=True, verbose=False)
+        # Only the header and events are read, the sample data stays on disk
+        epochs = mne.read_epochs(fif_file, preload=False, verbose=False)
         # Print number of channels
         print(f"Number of channels: {len(epochs.ch_names)}")
         y = epochs.events[:, -1]
-        epochs_all.append(epochs)
         y_all.append(y)
 
-        # Load features from .npy file
-        features = np.load(npy_file)
-        features = features.reshape(features.shape[0], -1)  # Flatten if needed
-        X_all.append(features)
+        # Memory-map features from .npy file, they were computed with the sLORETA engine and every source
+        features = np.load(npy_file, mmap_mode='r')
+        X_all.append(stored_features(features, "sloreta", None, lambda: epochs, engine, kernel))
 
-    # Concatenate all epochs and labels
-    epochs_all = mne.concatenate_epochs(epochs_all, verbose=False)
-    
+    for session in sessions:
+        print(f"Loading {session.stem}")
+        y_all.append(session.labels)
+        features = session.features() if session.has_features() else None
+        load_epochs = lambda: mne.concatenate_epochs([session[i] for i in range(len(session))], verbose=False)
+        X_all.append(stored_features(features, session.meta.get("feature_engine", "sloreta"), session.meta.get("source_roi"), load_epochs, engine, kernel))
+
+    # Concatenate all labels and features
     y_all = np.concatenate(y_all)
     X_all = np.concatenate(X_all)
     print(f"Feature matrix shape: {X_all.shape}")
     print(f"Label matrix shape: {y_all.shape}")
 
     # Initialize and train the LDA classifier
-    clf = make_pipeline(StandardScaler(),PCA(n_components=0.95),LinearDiscriminantAnalysis())
+    clf = make_classifier(engine)
     clf.fit(X_all, y_all)
-
-    print("Creating inverse operator from training data")
-    inverse_operator = create_inverse_operator(epochs_all.info)
+    save_classifier(folder, clf, {
+        "fingerprint": fingerprint,
+        "files": [os.path.basename(f) for f in data_files],
+        "feature_engine": engine,
+        "preprocessing": PREPROCESSING_MODE,
+        "feature_bands": F_BANDS,
+        "feature_tmin": FEATURE_TMIN,
+        "feature_tmax": FEATURE_TMAX,
+        "source_roi": source_roi() if engine == "sloreta" else None,
+        "ch_names": info['ch_names'],
+        "n_trials": len(y_all),
+        "created": time.strftime('%Y-%m-%d %H:%M:%S'),
+    })
 
     return clf, inverse_operator
 
@@ -99,63 +303,3 @@ def print_results(predictions, y_test):
     print("\n" + "-" * 30)
     print(f"\nAccuracy: {accuracy:.2%}")
     print(f"Length of predictions: {len(predictions)}")
-
-def save_results(predictions, y_test, subject_number):
-    # Convert to lists for JSON serialization
-
-    predictions = np.array(predictions).flatten()
-    y_test = np.array(y_test).flatten()
-
-    score = int(np.sum(predictions == y_test))
-
-    predictions = predictions.tolist()
-    y_test = y_test.tolist()
-
-    # Define the file path inside the folder
-    folder_path = f"data/s{str(subject_number).zfill(2)}"
-    file_path = os.path.join(folder_path, "test_results.json")
-
-    # Ensure the directory exists
-    os.makedirs(folder_path, exist_ok=True)
-
-    # Compute metrics
-    accuracy = accuracy_score(y_test, predictions)
-    right_recall = recall_score(y_test, predictions, zero_division=0)  # How well right (1) is predicted
-    precision = precision_score(y_test, predictions, zero_division=0)
-    f1 = f1_score(y_test, predictions, zero_division=0)
-
-    # Compute left_recall (specificity)
-    tn, fp, fn, tp = confusion_matrix(y_test, predictions).ravel()
-    left_recall = tn / (tn + fp) if (tn + fp) > 0 else 0  # Sensitivity for left (0)
-
-    # Load existing results if the file exists
-    if os.path.exists(file_path):
-        with open(file_path, "r") as file:
-            try:
-                results = json.load(file)
-            except json.JSONDecodeError:
-                results = {}  # Handle cases where the file is empty or corrupted
-    else:
-        results = {}
-
-    # Determine the next test number
-    test_number = len(results) + 1
-    test_key = f"test_{test_number}"
-
-    # Store new results
-    results[test_key] = {
-        "score": score,
-        "predictions": predictions,
-        "y_test": y_test,
-        "accuracy": accuracy,
-        "right_recall": right_recall, 
-        "left_recall": left_recall,  
-        "f1": f1,
-        "precision": precision
-    }
-
-    # Save updated results to file
-    with open(file_path, "w") as file:
-        json.dump(results, file, indent=4)
-
-    print(f"Test {test_number} for subject {subject_number} saved successfully in {file_path}!")
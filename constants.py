@@ -8,10 +8,18 @@ SAMPLE_WINDOW = BEFORE_MARKER_TIME+MARKER_TIME
 # Data stream
 STREAM_NAME = "apple_game"
 # STREAM_NAME = "Explore_8547_ExG"
+RING_BUFFER_SECONDS = 30 # Length of the continuously filled sample buffer
 
 # Game settings
 FPS = 30
+SIMULATION_RATE = 240 # Fixed game logic steps per second, independent of FPS
+SIMULATION_STEP = 1/SIMULATION_RATE
+RENDER_MODE = "cached" # "cached" redraws only what changed from pre-rendered layers, "full" redraws the whole screen every frame
 END_VALUE = 20 
+# What to do with a trial whose classification arrives after its apple has left the screen:
+# "keep" stores it without opening a hand, "discard" drops the trial
+INFERENCE_TIMEOUT_POLICY = "keep"
+TRACING = True # Write per-stage timings of every session to {run_id}_trace.tsv, summarize with tracing.py
 
 # Sizes
 scale = 1.9
@@ -141,10 +149,54 @@ CH_NAMES_64 =[
     "O2",
 ]
 
+CH_NAMES_BY_COUNT = {4: CH_NAMES_4, 8: CH_NAMES_8, 32: CH_NAMES_32, 64: CH_NAMES_64}
+
 # Preprocessing constants
 F_LOW = 1
 F_HIGH = 50
 F_NOTCH = 50
+# Filter and re-reference causally as samples arrive instead of per trial. The causal filters give
+# different features than the zero-phase filters of the offline path, so sessions record which one
+# they used and a classifier is only trained on sessions of the current one
+STREAMING_PREPROCESSING = False
+PREPROCESSING_MODE = "streaming" if STREAMING_PREPROCESSING else "offline"
+# The filter bank in preprocessing filters all bands in one pass, so the five band set is affordable
 # F_BANDS = [(4,8),(8,12),(12,20),(20,30),(30,45)]
 F_BANDS = [(7,11),(9,13)]
+FEATURE_TMIN = -0.1 # Crop window of the features, relative to the marker
+FEATURE_TMAX = 1.4
+# How features are computed from the filter bank epochs: "sloreta" source power, which needs the
+# inverse operator, "logvar" log-variance per channel, "csp" filter bank CSP, or "auto" for
+# "sloreta" with at least SOURCE_MIN_CHANNELS channels and "csp" below that
+FEATURE_ENGINE = "auto"
+SOURCE_MIN_CHANNELS = 16
+CSP_COMPONENTS = 4 # Spatial filters per band, half from each end of the spectrum
+# Anatomical labels of the fsaverage parcellation the source features are limited to, in both
+# hemispheres, e.g. ["precentral", "postcentral"]. None keeps every source
+SOURCE_ROI = None
+SOURCE_ROI_MODE = "mean" # "mean" averages the source power over each label, "restrict" keeps every source in the labels
+ROI_PARCELLATION = "aparc"
+
+# Classifier settings
+ADAPTIVE_CLASSIFIER = False # Keep updating the LDA with every labeled trial in test mode
+ADAPTATION_RATE = 0.05 # Weight of the newest trial in the adapted class means
+ADAPTATION_RATE_COVARIANCE = 0.005 # and in the adapted shared covariance
+
+# Inference server, see inference_server.py. With an address the game sends its test trials
+# there instead of loading its own classifier and inverse operator. A path is a Unix socket,
+# "host:port" a TCP socket, e.g. "/tmp/apple_catcher.sock" or "localhost:5757"
+INFERENCE_SERVER = None
+INFERENCE_BATCH_WINDOW = 0.005 # Seconds the server waits for more requests to classify together
+INFERENCE_MAX_BATCH = 16
+
+# Cache settings
+CACHE_DIR = "cache"
+INVERSE_CACHE_DIR = CACHE_DIR + "/inverse"
+INVERSE_CACHE_MAX_BYTES = 2*1024**3 # Least recently used entries are evicted above this size
+GIGA_CACHE_DIR = CACHE_DIR + "/giga"
+FEATURE_CACHE_DIR = CACHE_DIR + "/features"
+FEATURE_CACHE_MAX_BYTES = 1024**3
+
+# GIGA dataset
+GIGA_SUBJECTS = list(range(1, 53))
 
@@ -1,8 +1,107 @@
+import json
+import os
+import threading
+import time
 import numpy as np
 import pylsl
 import mne
-import pymatreader
 from constants import *
+from tracing import span
+
+LSL_DTYPES = {
+    pylsl.cf_float32: np.float32,
+    pylsl.cf_double64: np.float64,
+    pylsl.cf_int8: np.int8,
+    pylsl.cf_int16: np.int16,
+    pylsl.cf_int32: np.int32,
+    pylsl.cf_int64: np.int64,
+}
+
+class LSLRingBuffer:
+    """Pulls an inlet continuously on a background thread into a preallocated ring
+    buffer, so trial windows can be read without draining the inlet into lists."""
+
+    def __init__(self, inlet, offset, seconds=RING_BUFFER_SECONDS, chunk_time=0.05, preprocessor=None):
+        info = inlet.info()
+        self.inlet = inlet
+        self.offset = offset
+        self.preprocessor = preprocessor
+        self.n_channels = info.channel_count()
+        self.capacity = int(seconds*info.nominal_srate())
+        self.chunk_samples = max(int(chunk_time*info.nominal_srate()), 1)
+
+        # Samples are stored row-wise so that any run of rows is a valid pull_chunk destination
+        # Preprocessed samples are pulled into the scratch buffer and stored as float64
+        dtype = LSL_DTYPES[info.channel_format()]
+        self.data = np.zeros((self.capacity, self.n_channels), dtype=dtype if preprocessor is None else np.float64)
+        self.timestamps = np.full(self.capacity, -np.inf)
+        self.scratch = np.zeros((self.chunk_samples, self.n_channels), dtype=dtype)
+        self.write_index = 0
+        self.last_timestamp = -np.inf
+
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._pull_loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+    def _pull_loop(self):
+        while self.running:
+            start = self.write_index
+            direct = self.preprocessor is None and self.capacity - start >= self.chunk_samples
+            if direct:
+                # Pull straight into the ring, after hiding the oldest rows from readers
+                with self.lock:
+                    self.timestamps[start:start+self.chunk_samples] = -np.inf
+                dest = self.data[start:start+self.chunk_samples]
+            else:
+                dest = self.scratch
+            _, timestamps = self.inlet.pull_chunk(timeout=0.1, max_samples=self.chunk_samples, dest_obj=dest)
+            n = len(timestamps)
+            if n == 0:
+                continue
+            timestamps = np.array(timestamps) + self.offset
+            if not direct:
+                chunk = self.scratch[:n]
+                if self.preprocessor is not None:
+                    chunk = self.preprocessor.process(chunk.T.astype(np.float64)).T
+
+            with self.lock:
+                if direct:
+                    self.timestamps[start:start+n] = timestamps
+                else:
+                    first = min(n, self.capacity-start)
+                    self.data[start:start+first] = chunk[:first]
+                    self.timestamps[start:start+first] = timestamps[:first]
+                    self.data[:n-first] = chunk[first:]
+                    self.timestamps[:n-first] = timestamps[first:]
+                self.write_index = (start+n) % self.capacity
+                self.last_timestamp = max(self.last_timestamp, timestamps.max())
+
+    def wait_for(self, end_time, timeout=1.0):
+        """Blocks until a sample at or after end_time has arrived, or timeout seconds."""
+        deadline = time.perf_counter() + timeout
+        while self.last_timestamp < end_time and time.perf_counter() < deadline:
+            time.sleep(0.005)
+
+    def get_window(self, duration, end_time):
+        """Returns the samples (n_channels x n_samples) and timestamps of the last
+        duration seconds ending at end_time, in arrival order."""
+        with self.lock:
+            mask = (self.timestamps > end_time-duration) & (self.timestamps <= end_time)
+            idx = np.flatnonzero(mask)
+            idx = idx[np.argsort((idx-self.write_index) % self.capacity, kind='stable')]
+            sample = self.data[idx].T.astype(np.float64)
+            timestamps = self.timestamps[idx]
+        return sample, timestamps
 
 def create_lsl_inlet(stream_name):
     streams = pylsl.resolve_stream('name',stream_name)
@@ -30,22 +129,30 @@ def create_mne_info(inlet):
     info.set_montage(mne.channels.make_standard_montage('standard_1020'))
     return info
 
-def collect_data(inlet,inlet_info,offset):
+def collect_data(inlet,inlet_info,offset,ring_buffer=None,end_time=None):
     sfreq = inlet_info['sfreq']
 
-    # Pull data from the given window
-    sample,timestamps = inlet.pull_chunk(timeout = 0.0 , max_samples=int(sfreq*SAMPLE_WINDOW))
-    sample = np.array(sample).transpose()
-    timestamps = np.array(timestamps)+offset
+    if ring_buffer is None:
+        # Pull data from the given window
+        sample,timestamps = inlet.pull_chunk(timeout = 0.0 , max_samples=int(sfreq*SAMPLE_WINDOW))
+        sample = np.array(sample).transpose()
+        timestamps = np.array(timestamps)+offset
+    else:
+        # Read the window ending at end_time (local LSL clock) from the ingestion thread
+        ring_buffer.wait_for(end_time)
+        sample,timestamps = ring_buffer.get_window(SAMPLE_WINDOW,end_time)
 
     shape = sample.shape
     if shape!=(len(inlet_info['ch_names']),sfreq*SAMPLE_WINDOW):
         print(f"Sample was smaller than expected: {shape}")
     
+    # The acquisition timestamps in the sample order timestep_correction sorts to, for the session store
+    raw_timestamps = np.sort(timestamps)
     # Correct for out of order samples and jitter
-    sample,timestamps = timestep_correction(sample,timestamps,out_of_order=True,dejitter=True)
+    with span("timestep_correction"):
+        sample,timestamps = timestep_correction(sample,timestamps,out_of_order=True,dejitter=True)
 
-    return sample,timestamps
+    return sample,timestamps,raw_timestamps
 
 def timestep_correction(sample,timestamps,out_of_order = True,dejitter = True):
     min = np.min(timestamps)
@@ -62,10 +169,90 @@ def timestep_correction(sample,timestamps,out_of_order = True,dejitter = True):
         timestamps = np.linspace(min,max,len(timestamps))
     return sample, timestamps
 
-def clear_lsl_buffer(inlet):
-    # Pull all remaining data in the buffer to clear it
-    sample,timestamps = inlet.pull_chunk(timeout =0.0 , max_samples=10000000)
-    return len(sample)
+def giga_mat_file(subject_number):
+    return "giga_mat_files/s" + str(subject_number).zfill(2) + ".mat"
+
+def giga_bin_folder(subject_number):
+    return "giga_bin_files/s" + str(subject_number).zfill(2)
+
+def giga_conversion_current(subject_number):
+    """True when the subject was converted from the .mat file as it is now. A conversion
+    whose .mat file was removed since is still used."""
+    meta_file = giga_bin_folder(subject_number) + "/meta.json"
+    if not os.path.exists(meta_file):
+        return False
+    mat_file = giga_mat_file(subject_number)
+    if not os.path.exists(mat_file):
+        return True
+    with open(meta_file, "r") as file:
+        source = json.load(file).get("source")
+    stat = os.stat(mat_file)
+    return source == {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def giga_data_file(subject_number):
+    """The file load_giga_data reads for a subject: the converted meta data if it is
+    current, else the .mat file."""
+    if giga_conversion_current(subject_number):
+        return giga_bin_folder(subject_number) + "/meta.json"
+    return giga_mat_file(subject_number)
+
+def giga_bad_trials(bad_trial_indices, side):
+    """0-based indices of the trials of one side (0 is left, 1 is right) that are marked
+    as bad for motor imagery or voltage."""
+    bad_trials = []
+    for key in ["bad_trial_idx_mi", "bad_trial_idx_voltage"]:
+        indices = bad_trial_indices[key][side]
+        if isinstance(indices, list):
+            bad_trials += list(indices)
+    return [int(x) - 1 for x in bad_trials]
+
+def convert_giga_data(subject_number):
+    """Converts a subject's .mat file once into .npy arrays and a meta.json file in
+    giga_bin_files/sNN, which load_giga_data memory-maps instead of decoding the .mat file."""
+    import pymatreader # Only needed for the conversion
+    rawdata = pymatreader.read_mat(giga_mat_file(subject_number))
+    folder = giga_bin_folder(subject_number)
+    os.makedirs(folder, exist_ok=True)
+
+    for name in ["imagery_left", "imagery_right"]:
+        np.save(f"{folder}/{name}.npy", np.ascontiguousarray(rawdata["eeg"][name]))
+    stat = os.stat(giga_mat_file(subject_number))
+    meta = {
+        "srate": float(rawdata["eeg"]["srate"]),
+        "subject": rawdata["eeg"]["subject"],
+        "imagery_events": np.flatnonzero(rawdata["eeg"]["imagery_event"] == 1).tolist(),
+        "bad_trials_left": giga_bad_trials(rawdata["eeg"]["bad_trial_indices"], 0),
+        "bad_trials_right": giga_bad_trials(rawdata["eeg"]["bad_trial_indices"], 1),
+        "source": {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns},
+    }
+    # The meta data is written last, so a folder without it is an unfinished conversion
+    with open(f"{folder}/meta.json.tmp", "w") as file:
+        json.dump(meta, file, indent=4)
+    os.replace(f"{folder}/meta.json.tmp", f"{folder}/meta.json")
+
+def read_giga_data(subject_number):
+    """Imagery arrays, event samples, sample rate, subject id and bad trials of a subject.
+    The arrays are memory-mapped when the subject was converted with convert_giga_data."""
+    data_file = giga_data_file(subject_number)
+    if data_file.endswith("meta.json"):
+        folder = giga_bin_folder(subject_number)
+        with open(data_file, "r") as file:
+            meta = json.load(file)
+        meta["imagery_left"] = np.load(f"{folder}/imagery_left.npy", mmap_mode='r')
+        meta["imagery_right"] = np.load(f"{folder}/imagery_right.npy", mmap_mode='r')
+        return meta
+
+    import pymatreader
+    rawdata = pymatreader.read_mat(data_file)
+    return {
+        "srate": rawdata["eeg"]["srate"],
+        "subject": rawdata["eeg"]["subject"],
+        "imagery_left": rawdata["eeg"]["imagery_left"],
+        "imagery_right": rawdata["eeg"]["imagery_right"],
+        "imagery_events": np.flatnonzero(rawdata["eeg"]["imagery_event"] == 1).tolist(),
+        "bad_trials_left": giga_bad_trials(rawdata["eeg"]["bad_trial_indices"], 0),
+        "bad_trials_right": giga_bad_trials(rawdata["eeg"]["bad_trial_indices"], 1),
+    }
 
 def load_giga_data(
     subject_number,
@@ -108,21 +295,20 @@ def load_giga_data(
         The epochs for the right hand imagery.
     """
     ch_types = ["eeg" for i in range(64)]
-    rawdata = pymatreader.read_mat(
-        "giga_mat_files/s" + str(subject_number).zfill(2)+".mat"
-    )
+    rawdata = read_giga_data(subject_number)
 
     montage = mne.channels.make_standard_montage("biosemi64")
     info = mne.create_info(
         CH_NAMES_64,
-        rawdata["eeg"]["srate"],
+        rawdata["srate"],
         ch_types=ch_types,
         verbose=False
     ).set_montage(montage)
-    info["subject_info"] = dict(id=subject_number, his_id=rawdata["eeg"]["subject"])
+    info["subject_info"] = dict(id=subject_number, his_id=rawdata["subject"])
 
-    MI_left = rawdata["eeg"]["imagery_left"]
-    MI_right = rawdata["eeg"]["imagery_right"]
+    # Slicing a memory-mapped array only reads the 64 EEG channels from disk
+    MI_left = rawdata["imagery_left"]
+    MI_right = rawdata["imagery_right"]
     raw_array_left = mne.io.RawArray(MI_left[:64] * 1e-8, info, verbose=False)
     raw_array_right = mne.io.RawArray(MI_right[:64] * 1e-8, info, verbose=False)
 
@@ -142,13 +328,9 @@ def load_giga_data(
         raw_array_left.notch_filter(notch_filter, verbose=False)
         raw_array_right.notch_filter(notch_filter, verbose=False)
 
-    imagery_event = rawdata["eeg"]["imagery_event"]
     event_id_left = {"MI_left": 0}
     event_id_right = {"MI_right": 1}
-    event_indexes = []
-    for i in range(len(imagery_event)):
-        if imagery_event[i] == 1:
-            event_indexes.append(i)
+    event_indexes = rawdata["imagery_events"]
     events_left = np.array(
         [event_indexes, [0] * len(event_indexes), [0] * len(event_indexes)]
     ).T
@@ -180,41 +362,8 @@ def load_giga_data(
         verbose=False
     )
 
-    bad_epochs_left = [
-        x - 1
-        for x in (
-            list(rawdata["eeg"]["bad_trial_indices"]["bad_trial_idx_mi"][0])
-            if isinstance(
-                rawdata["eeg"]["bad_trial_indices"]["bad_trial_idx_mi"][0], list
-            )
-            else []
-        )
-        + (
-            list(rawdata["eeg"]["bad_trial_indices"]["bad_trial_idx_voltage"][0])
-            if isinstance(
-                rawdata["eeg"]["bad_trial_indices"]["bad_trial_idx_voltage"][0], list
-            )
-            else []
-        )
-    ]
-
-    bad_epochs_right = [
-        x - 1
-        for x in (
-            list(rawdata["eeg"]["bad_trial_indices"]["bad_trial_idx_mi"][1])
-            if isinstance(
-                rawdata["eeg"]["bad_trial_indices"]["bad_trial_idx_mi"][1], list
-            )
-            else []
-        )
-        + (
-            list(rawdata["eeg"]["bad_trial_indices"]["bad_trial_idx_voltage"][1])
-            if isinstance(
-                rawdata["eeg"]["bad_trial_indices"]["bad_trial_idx_voltage"][1], list
-            )
-            else []
-        )
-    ]
+    bad_epochs_left = rawdata["bad_trials_left"]
+    bad_epochs_right = rawdata["bad_trials_right"]
 
     epochs_left.drop(bad_epochs_left, verbose=False)
     epochs_right.drop(bad_epochs_right, verbose=False)
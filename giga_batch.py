@@ -0,0 +1,130 @@
+import argparse
+import os
+import time
+import mne
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from constants import *
+from cache import cache_lookup, cache_path, hash_key
+from data_collection import convert_giga_data, giga_conversion_current, giga_data_file, giga_mat_file, load_giga_data
+from preprocessing import create_inverse_operator, extract_features_cached, inverse_operator_cache_key, prepare_source_kernel, preprocess_giga_data, source_roi
+
+def giga_cache_key(subject_number, options):
+    """Key built from the subject, the load_giga_data options and the source file, so
+    replacing or converting a .mat file or changing an option never returns stale epochs."""
+    stat = os.stat(giga_data_file(subject_number))
+    options = {k: tuple(v) if isinstance(v, list) else v for k, v in options.items()}
+    return hash_key("giga", subject_number, sorted(options.items()), stat.st_size, stat.st_mtime_ns, mne.__version__)
+
+def load_giga_epochs(subject_number, use_cache=True, **options):
+    """Epochs and labels of a subject as load_giga_data and preprocess_giga_data return
+    them, read from GIGA_CACHE_DIR when they were computed with the same options before."""
+    options["epochs_only"] = True
+    key = giga_cache_key(subject_number, options)
+    path = cache_lookup(GIGA_CACHE_DIR, key, "-epo.fif") if use_cache else None
+    if path is not None:
+        epochs = mne.read_epochs(path, preload=True, verbose=False)
+        return epochs, epochs.events[:, -1]
+
+    epochs_left, epochs_right = load_giga_data(subject_number, **options)
+    epochs, _ = preprocess_giga_data(epochs_left, epochs_right)
+
+    # Written under a temporary name first so a crash never leaves a partial entry
+    path = cache_path(GIGA_CACHE_DIR, key, "-epo.fif")
+    tmp_path = cache_path(GIGA_CACHE_DIR, f"{key}.{os.getpid()}.tmp", "-epo.fif")
+    epochs.save(tmp_path, fmt="double", overwrite=True, verbose=False)
+    os.replace(tmp_path, path)
+    return epochs, epochs.events[:, -1]
+
+def load_giga_features(subject_number, tmin=FEATURE_TMIN, tmax=FEATURE_TMAX, decimation_factor=1, frequencies=F_BANDS, roi=SOURCE_ROI, roi_mode=SOURCE_ROI_MODE, **options):
+    """Source band power features and labels of a subject, cached next to its epochs.
+    The features are returned memory-mapped when they come from the cache."""
+    options["epochs_only"] = True
+    epochs_key = giga_cache_key(subject_number, options)
+    epochs = None
+    epochs_path = cache_lookup(GIGA_CACHE_DIR, epochs_key, "-epo.fif")
+    if epochs_path is not None:
+        info = mne.io.read_info(epochs_path, verbose=False)
+    else:
+        epochs, _ = load_giga_epochs(subject_number, **options)
+        info = epochs.info
+
+    key = hash_key("giga_features", epochs_key, inverse_operator_cache_key(info), tmin, tmax, decimation_factor, frequencies, source_roi(roi, roi_mode))
+    features_path = cache_lookup(GIGA_CACHE_DIR, key, "-features.npy")
+    labels_path = cache_lookup(GIGA_CACHE_DIR, key, "-labels.npy")
+    if features_path is not None and labels_path is not None:
+        return np.load(features_path, mmap_mode='r'), np.load(labels_path)
+
+    if epochs is None:
+        epochs, _ = load_giga_epochs(subject_number, **options)
+    kernel = prepare_source_kernel(create_inverse_operator(epochs.info), roi=roi, roi_mode=roi_mode)
+    X = extract_features_cached(epochs, None, tmin, tmax, decimation_factor, frequencies, kernel=kernel)
+    y = epochs.events[:, -1]
+    for suffix, array in [("-labels.npy", y), ("-features.npy", X)]:
+        tmp_path = cache_path(GIGA_CACHE_DIR, f"{key}.{os.getpid()}.tmp", suffix)
+        np.save(tmp_path, array)
+        os.replace(tmp_path, cache_path(GIGA_CACHE_DIR, key, suffix))
+    return X, y
+
+def _preprocess_subject(subject_number, use_cache, convert, options):
+    start = time.perf_counter()
+    if convert and not giga_conversion_current(subject_number):
+        convert_giga_data(subject_number)
+    cached = use_cache and cache_lookup(GIGA_CACHE_DIR, giga_cache_key(subject_number, dict(options, epochs_only=True)), "-epo.fif") is not None
+    epochs, labels = load_giga_epochs(subject_number, use_cache, **options)
+    # Only a summary is sent back, the epochs stay in the cache
+    return subject_number, len(labels), int(np.sum(labels == 1)), cached, time.perf_counter()-start
+
+def preprocess_giga_subjects(subjects=GIGA_SUBJECTS, n_jobs=None, use_cache=True, convert=False, **options):
+    """Runs load_giga_epochs for every subject in a process pool, first converting the
+    .mat files that were not converted yet when convert is set. A worker reading a .mat
+    file holds all of it in memory, so n_jobs also bounds the peak memory use."""
+    subjects = [s for s in subjects if os.path.exists(giga_data_file(s))]
+    if len(subjects) == 0:
+        print("No GIGA subjects found in giga_mat_files/")
+        return []
+    n_jobs = min(n_jobs or os.cpu_count(), len(subjects))
+    results = []
+    with ProcessPoolExecutor(n_jobs) as executor:
+        futures = {executor.submit(_preprocess_subject, s, use_cache, convert, options): s for s in subjects}
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                subject_number, n_epochs, n_right, cached, seconds = future.result()
+            except Exception as e:
+                print(f"Subject {futures[future]} failed: {e}")
+                continue
+            results.append((subject_number, n_epochs, n_right, cached, seconds))
+            source = "cache" if cached else "computed"
+            print(f"[{done}/{len(subjects)}] Subject {subject_number}: {n_epochs} epochs ({n_epochs-n_right} left, {n_right} right), {source} in {seconds:.1f} s")
+    return sorted(results)
+
+def add_giga_arguments(parser):
+    """The load_giga_data options as command line arguments, shared with benchmark.py."""
+    parser.add_argument("--subjects", type=int, nargs="+", default=GIGA_SUBJECTS)
+    parser.add_argument("--jobs", type=int, default=None, help="Worker processes, each holds one subject in memory")
+    parser.add_argument("--filter", type=float, nargs=2, default=None, metavar=("LOW", "HIGH"))
+    parser.add_argument("--notch", type=float, default=None)
+    parser.add_argument("--baseline", type=float, nargs=2, default=None, metavar=("TMIN", "TMAX"))
+    parser.add_argument("--reject", type=float, default=None, help="Peak-to-peak EEG rejection threshold in V")
+    parser.add_argument("--no-reference", action="store_true", help="Skip the average reference")
+
+def giga_options(args):
+    return {
+        "set_average_reference": not args.no_reference,
+        "filter": tuple(args.filter) if args.filter is not None else None,
+        "baseline": tuple(args.baseline) if args.baseline is not None else None,
+        "reject": dict(eeg=args.reject) if args.reject is not None else None,
+        "notch_filter": args.notch,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Preprocess the GIGA subjects in parallel and cache their epochs")
+    add_giga_arguments(parser)
+    parser.add_argument("--no-cache", action="store_true", help="Recompute every subject and overwrite its cache entry")
+    parser.add_argument("--convert", action="store_true", help="Convert the .mat files to memory-mappable arrays in giga_bin_files/ first, again when a .mat file changed")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    results = preprocess_giga_subjects(args.subjects, args.jobs, not args.no_cache, args.convert, **giga_options(args))
+    n_cached = sum(cached for _, _, _, cached, _ in results)
+    print(f"\n{len(results)} subjects ({n_cached} from cache) in {time.perf_counter()-start:.1f} s")
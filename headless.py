@@ -0,0 +1,93 @@
+import argparse
+import json
+import os
+import time
+import numpy as np
+
+# Render into memory; this has to happen before pygame is imported
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+from constants import *
+from apple_catcher_game import Apple_catcher_game
+
+def summarize_times(times):
+    times = np.array(times)*1000
+    if len(times) == 0:
+        return {"n": 0}
+    return {
+        "n": len(times),
+        "mean": float(np.mean(times)),
+        "p50": float(np.percentile(times, 50)),
+        "p90": float(np.percentile(times, 90)),
+        "p99": float(np.percentile(times, 99)),
+        "max": float(np.max(times)),
+    }
+
+class SyntheticGame(Apple_catcher_game):
+    """Game that tells the synthetic outlet which side every new apple falls on."""
+    outlet = None
+
+    def start_trial_clock(self):
+        super().start_trial_clock()
+        self.outlet.start_trial(int(self.apple_pos[0] > SCREEN_WIDTH/2), self.lsl_start_time)
+
+def frame_report(frame_starts, fps=FPS):
+    frame_times = np.diff(frame_starts)
+    # A frame that took k frame periods dropped k-1 frames
+    dropped = int(np.sum(np.maximum(np.round(frame_times*fps)-1, 0)))
+    return summarize_times(frame_times), dropped
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the game without a display and report frame and inference timing")
+    parser.add_argument("--subject", type=int, required=True)
+    parser.add_argument("--mode", choices=["test", "training", "define"], default="define")
+    parser.add_argument("--end-value", type=int, default=END_VALUE)
+    parser.add_argument("--output", default=None, help="Write the report as JSON to this file")
+    parser.add_argument("--render", choices=["cached", "full"], default=RENDER_MODE)
+    parser.add_argument("--synthetic", type=int, default=None, choices=sorted(CH_NAMES_BY_COUNT),
+                        help="Stream synthetic EEG with this many channels instead of waiting for the headset")
+    parser.add_argument("--sfreq", type=float, default=250., help="Sample rate of the synthetic stream")
+    args = parser.parse_args()
+
+    if args.synthetic is not None:
+        from synthetic_stream import SyntheticMIOutlet
+        # The outlet has to exist before the game resolves the stream
+        SyntheticGame.outlet = SyntheticMIOutlet(args.synthetic, args.sfreq)
+        SyntheticGame.outlet.start()
+        game = SyntheticGame(subject_number=args.subject)
+    else:
+        game = Apple_catcher_game(subject_number=args.subject)
+    game.game_mode = args.mode
+    game.end_value = args.end_value
+    game.render_mode = args.render
+
+    start = time.perf_counter()
+    game.run()
+    duration = time.perf_counter()-start
+    if args.synthetic is not None:
+        SyntheticGame.outlet.stop()
+
+    frame_times, dropped = frame_report(game.frame_starts)
+    report = {
+        "created": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "subject": args.subject,
+        "mode": args.mode,
+        "end_value": args.end_value,
+        "synthetic_channels": args.synthetic,
+        "synthetic_sfreq": args.sfreq if args.synthetic is not None else None,
+        "fps": FPS,
+        "render_mode": args.render,
+        "duration_s": duration,
+        "frame_time_ms": frame_times,
+        "dropped_frames": dropped,
+        "hand_latency_ms": summarize_times(game.hand_latencies),
+        "startup_s": game.startup_times,
+    }
+
+    print(f"\nFrame time: p50 {frame_times.get('p50', 0):.1f} ms, p99 {frame_times.get('p99', 0):.1f} ms, max {frame_times.get('max', 0):.1f} ms")
+    print(f"Dropped frames at {FPS} FPS: {dropped}")
+    print(f"Marker window close to open hand: p50 {report['hand_latency_ms'].get('p50', 0):.1f} ms over {report['hand_latency_ms']['n']} trials")
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=4)
+        print(f"Report written to {args.output}")
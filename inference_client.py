@@ -0,0 +1,110 @@
+import io
+import json
+import socket
+import struct
+import numpy as np
+from constants import *
+
+# Every message is a 4 byte big-endian header length, a JSON header and, when the header's
+# payload_bytes is not 0, one array in .npy format. Arrays are never pickled, so a message
+# from another process can not run code in the receiver.
+# This module only needs numpy, so the game can use the server without importing mne or sklearn.
+
+DEFAULT_ADDRESS = "localhost:5757"
+
+def parse_address(address):
+    """Socket family and address of a Unix socket path or a "host:port" string."""
+    if ":" in address and not address.startswith(("/", ".")):
+        host, port = address.rsplit(":", 1)
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, address
+
+def recv_exactly(sock, n):
+    buffer = bytearray(n)
+    view = memoryview(buffer)
+    received = 0
+    while received < n:
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            raise ConnectionError("Connection closed by the other end")
+        received += count
+    return buffer
+
+def send_message(sock, header, array=None):
+    payload = b""
+    if array is not None:
+        buffer = io.BytesIO()
+        np.save(buffer, np.ascontiguousarray(array), allow_pickle=False)
+        payload = buffer.getbuffer()
+    head = json.dumps(dict(header, payload_bytes=len(payload))).encode()
+    sock.sendall(struct.pack("!I", len(head)) + head)
+    if len(payload) > 0:
+        sock.sendall(payload)
+
+def recv_message(sock):
+    """The header and array of the next message, array is None when there was none."""
+    (head_length,) = struct.unpack("!I", recv_exactly(sock, 4))
+    header = json.loads(recv_exactly(sock, head_length))
+    array = None
+    if header.get("payload_bytes", 0) > 0:
+        array = np.load(io.BytesIO(recv_exactly(sock, header["payload_bytes"])), allow_pickle=False)
+    return header, array
+
+class InferenceClient:
+    """Connection to inference_server.py. Requests are sent one at a time, the game's
+    inference worker is the only thread that uses it."""
+
+    def __init__(self, address=INFERENCE_SERVER, timeout=30.0):
+        self.family, self.address = parse_address(address or DEFAULT_ADDRESS)
+        self.timeout = timeout
+        self.sock = None
+        self.connect()
+
+    def connect(self):
+        self.sock = socket.socket(self.family, socket.SOCK_STREAM)
+        self.sock.connect(self.address)
+        if self.family == socket.AF_INET:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def request(self, header, array=None, timeout=None):
+        """Sends a request and returns the reply, waiting at most timeout seconds, or forever for None."""
+        if self.sock is None:
+            self.connect()
+        try:
+            self.sock.settimeout(timeout)
+            send_message(self.sock, header, array)
+            header, array = recv_message(self.sock)
+        except OSError:
+            # A late reply would be read as the answer to the next request, so the connection is dropped
+            self.close()
+            raise
+        if not header.get("ok", False):
+            raise RuntimeError(f"Inference server: {header.get('error')}")
+        return header, array
+
+    def load(self, subject_number, reload=False):
+        """Makes the server load the classifier of a subject, returns False when the subject has no training data."""
+        # No timeout, the server may have to retrain the classifier and build the inverse operator first
+        header, _ = self.request({"op": "load", "subject": str(subject_number), "reload": reload}, timeout=None)
+        return header["trained"]
+
+    def predict(self, subject_number, epochs, labels=None):
+        """Features, predictions and class probabilities of the epochs, computed by the
+        server like extract_features and classifier.predict would. With labels the
+        server also adapts the subject's classifier when ADAPTIVE_CLASSIFIER is set."""
+        header = {
+            "op": "predict",
+            "subject": str(subject_number),
+            "ch_names": list(epochs.ch_names),
+            "sfreq": float(epochs.info['sfreq']),
+            "tmin": float(epochs.times[0]),
+            "preprocessing": PREPROCESSING_MODE,
+            "labels": None if labels is None else [int(label) for label in labels],
+        }
+        header, features = self.request(header, epochs.get_data(), self.timeout)
+        return features, np.array(header["prediction"]), np.array(header["proba"])
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
@@ -0,0 +1,200 @@
+import argparse
+import glob
+import os
+import queue
+import socket
+import threading
+import time
+import numpy as np
+from constants import *
+from classification import AdaptiveLDA, initialize_from_training_data
+from inference_client import DEFAULT_ADDRESS, parse_address, recv_message, send_message
+from preprocessing import extract_data_features, prepare_source_kernel, resolve_feature_engine
+
+def training_data_state(subject_number):
+    """Changes when a training session is added, grows or is replaced. Only checked when a
+    game station asks for the subject, never per prediction, since a running test session
+    grows with every trial."""
+    folder = f"data/s{str(subject_number).zfill(2)}"
+    files = []
+    for pattern in ["*_epo.fif", "*_features.npy", "*_session_index.bin"]:
+        files += glob.glob(f"{folder}/{pattern}")
+    stats = [(os.path.basename(f), os.stat(f)) for f in files]
+    return sorted((name, stat.st_size, stat.st_mtime_ns) for name, stat in stats)
+
+class _Request:
+    __slots__ = ("header", "data", "done", "reply", "features", "error")
+
+    def __init__(self, header, data):
+        self.header = header
+        self.data = data
+        self.done = threading.Event()
+        self.reply = None
+        self.features = None
+        self.error = None
+
+class InferenceServer:
+    """Holds the classifier and source kernel of every subject once for all game stations
+    on the machine. Each connection is served by its own thread, and predict requests
+    arriving within batch_window seconds of each other are classified together by a
+    single batch thread, which is also the only thread that touches the classifiers."""
+
+    def __init__(self, address=DEFAULT_ADDRESS, batch_window=INFERENCE_BATCH_WINDOW, max_batch=INFERENCE_MAX_BATCH):
+        self.family, self.address = parse_address(address)
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.models = {} # Subject number: {"classifier", "kernel", "state"}
+        self.load_locks = {}
+        self.lock = threading.Lock()
+        self.requests = queue.Queue()
+        self.n_batches = 0
+        self.n_requests = 0
+
+    def load_model(self, subject_number, reload=False, check=True):
+        """The model of a subject, loaded again when reload is set or, with check, when its
+        training data changed since it was loaded. Without check a loaded model is returned as is."""
+        subject_number = str(int(subject_number))
+        model = self.models.get(subject_number)
+        if model is not None and not reload and not check:
+            return model
+        with self.lock:
+            load_lock = self.load_locks.setdefault(subject_number, threading.Lock())
+        with load_lock:
+            state = training_data_state(subject_number)
+            model = self.models.get(subject_number)
+            if model is None or reload or model["state"] != state:
+                print(f"Loading subject {subject_number}")
+                classifier, inverse_operator = initialize_from_training_data(subject_number)
+                if ADAPTIVE_CLASSIFIER and classifier is not None:
+                    classifier = AdaptiveLDA(classifier)
+                # Only the kernel is kept, the inverse operator itself is most of the memory
+                kernel = prepare_source_kernel(inverse_operator) if inverse_operator is not None else None
+                model = {"classifier": classifier, "kernel": kernel, "state": state}
+                self.models[subject_number] = model
+            return model
+
+    def predict_batch(self, requests):
+        """Classifies requests of one subject with the same channels, sample rate and epoch window in one go."""
+        header = requests[0].header
+        # The live session of the requesting station must not trigger a retrain
+        model = self.load_model(header["subject"], check=False)
+        classifier = model["classifier"]
+        if classifier is None:
+            raise RuntimeError(f"No training data for subject {header['subject']}")
+        if header.get("preprocessing") != PREPROCESSING_MODE:
+            raise RuntimeError(f"The classifiers were trained on {PREPROCESSING_MODE} preprocessed sessions, not {header.get('preprocessing')}")
+
+        data = np.concatenate([request.data for request in requests])
+        sfreq = header["sfreq"]
+        times = (round(header["tmin"]*sfreq)+np.arange(data.shape[-1]))/sfreq
+        engine = resolve_feature_engine(len(header["ch_names"]))
+        X = extract_data_features(data, header["ch_names"], times, sfreq, model["kernel"], FEATURE_TMIN, FEATURE_TMAX, engine=engine)
+        prediction = classifier.predict(X)
+        proba = classifier.predict_proba(X)
+
+        start = 0
+        for request in requests:
+            end = start+len(request.data)
+            request.features = X[start:end]
+            request.reply = {"ok": True, "prediction": prediction[start:end].tolist(), "proba": proba[start:end].tolist()}
+            # Adapted after the batch is classified, like the game adapts after predicting each trial
+            labels = request.header.get("labels")
+            if ADAPTIVE_CLASSIFIER and labels is not None:
+                classifier.partial_fit(X[start:end], labels)
+            start = end
+
+    def _batch_loop(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.perf_counter()+self.batch_window
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.requests.get(timeout=max(deadline-time.perf_counter(), 0)))
+                except queue.Empty:
+                    break
+
+            groups = {}
+            for request in batch:
+                h = request.header
+                key = (h["subject"], tuple(h["ch_names"]), h["sfreq"], h["tmin"], request.data.shape[1:])
+                groups.setdefault(key, []).append(request)
+            for requests in groups.values():
+                try:
+                    self.predict_batch(requests)
+                except Exception as e:
+                    for request in requests:
+                        request.error = f"{type(e).__name__}: {e}"
+                for request in requests:
+                    request.done.set()
+            self.n_batches += 1
+            self.n_requests += len(batch)
+
+    def handle_connection(self, conn):
+        with conn:
+            while True:
+                try:
+                    header, data = recv_message(conn)
+                except (ConnectionError, OSError):
+                    return
+                try:
+                    if header["op"] == "load":
+                        model = self.load_model(header["subject"], header.get("reload", False))
+                        send_message(conn, {"ok": True, "trained": model["classifier"] is not None})
+                    elif header["op"] == "predict":
+                        request = _Request(header, data)
+                        self.requests.put(request)
+                        request.done.wait()
+                        if request.error is not None:
+                            send_message(conn, {"ok": False, "error": request.error})
+                        else:
+                            send_message(conn, request.reply, request.features)
+                    elif header["op"] == "stats":
+                        send_message(conn, {"ok": True, "subjects": sorted(self.models), "batches": self.n_batches, "requests": self.n_requests})
+                    else:
+                        send_message(conn, {"ok": False, "error": f"Unknown op {header['op']}"})
+                except (ConnectionError, OSError):
+                    return
+                except Exception as e:
+                    try:
+                        send_message(conn, {"ok": False, "error": f"{type(e).__name__}: {e}"})
+                    except (ConnectionError, OSError):
+                        return
+
+    def serve_forever(self):
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        if self.family == socket.AF_UNIX:
+            # A socket file left behind by a server that was killed would block the bind
+            if os.path.exists(self.address):
+                os.remove(self.address)
+        else:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(self.address)
+        sock.listen()
+        threading.Thread(target=self._batch_loop, daemon=True).start()
+        print(f"Inference server listening on {self.address}")
+        try:
+            while True:
+                conn, _ = sock.accept()
+                if self.family == socket.AF_INET:
+                    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                threading.Thread(target=self.handle_connection, args=(conn,), daemon=True).start()
+        finally:
+            sock.close()
+            if self.family == socket.AF_UNIX and os.path.exists(self.address):
+                os.remove(self.address)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the classifiers of several subjects to the game stations on this machine")
+    parser.add_argument("--address", default=INFERENCE_SERVER or DEFAULT_ADDRESS, help="Unix socket path or host:port")
+    parser.add_argument("--batch-window", type=float, default=INFERENCE_BATCH_WINDOW, help="Seconds to wait for requests to classify together")
+    parser.add_argument("--max-batch", type=int, default=INFERENCE_MAX_BATCH)
+    parser.add_argument("--subjects", type=int, nargs="*", default=[], help="Subjects to load before accepting connections")
+    args = parser.parse_args()
+
+    server = InferenceServer(args.address, args.batch_window, args.max_batch)
+    for subject_number in args.subjects:
+        server.load_model(subject_number)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"\nServed {server.n_requests} requests in {server.n_batches} batches")
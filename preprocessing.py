@@ -1,8 +1,19 @@
+import functools
 import mne
 import numpy as np
+import scipy.fft
+import scipy.signal
+try:
+    # Private MNE functions, checked with the MNE versions allowed in requirements.txt
+    from mne.minimum_norm.inverse import _assemble_kernel, _pick_channels_inverse_operator
+except ImportError:
+    _assemble_kernel = None
 import os
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from constants import *
+from cache import cache_lookup, cache_path, evict_cache, hash_key
+from tracing import span
 
 def source_reconstruction(epochs,inverse_operator,method='sLORETA',lambda2=None,snr=3.0,ori='normal') -> mne.SourceEstimate:
     if lambda2 is None:
@@ -17,6 +28,179 @@ def source_reconstruction(epochs,inverse_operator,method='sLORETA',lambda2=None,
     )
     return stc
 
+def fsaverage_subjects_dir():
+    return os.getcwd()+'/mne_data/MNE-sample-data/subjects'
+
+def roi_sources(inverse_operator,roi,mode,parcellation=ROI_PARCELLATION):
+    """Indices of the sources inside the roi labels of both hemispheres, and for mode
+    "mean" the (n_labels, n_roi_sources) matrix averaging their power per label."""
+    labels = mne.read_labels_from_annot('fsaverage',parc=parcellation,subjects_dir=fsaverage_subjects_dir(),verbose=False)
+    labels = [label for label in labels if label.name.rsplit('-',1)[0] in roi]
+    if len(labels) == 0:
+        raise ValueError(f"None of the labels {roi} are in the {parcellation} parcellation")
+
+    src = inverse_operator['src']
+    offsets = np.cumsum([0]+[s['nuse'] for s in src])
+    sources = []
+    for label in labels:
+        hemi = 0 if label.hemi == 'lh' else 1
+        sources.append(offsets[hemi]+np.flatnonzero(np.isin(src[hemi]['vertno'],label.vertices)))
+
+    projection = None
+    if mode == "mean":
+        projection = np.zeros((len(labels),sum(len(s) for s in sources)))
+        start = 0
+        for i, s in enumerate(sources):
+            projection[i,start:start+len(s)] = 1/max(len(s),1)
+            start += len(s)
+    return np.concatenate(sources), projection
+
+def source_roi(roi=SOURCE_ROI,roi_mode=SOURCE_ROI_MODE):
+    """Description of a source roi as stored in session and classifier metadata, None for every source."""
+    if roi is None:
+        return None
+    return {"labels": sorted(roi), "mode": roi_mode, "parcellation": ROI_PARCELLATION}
+
+def inverse_kernel_from_epochs(inverse_operator,method,lambda2,ori,nave,free_ori):
+    """The imaging kernel and its channels, read off by running apply_inverse_epochs on one
+    unit impulse per channel, for MNE versions without the private kernel functions. The
+    noise normalization is part of the kernel, and free orientations come out in head
+    coordinates, which leaves the summed power of every source unchanged."""
+    ch_names = inverse_operator['noise_cov']['names']
+    epochs = mne.EpochsArray(np.eye(len(ch_names))[None],mne.create_info(list(ch_names),1000.,'eeg'),verbose=False)
+    # The average reference projector of the inverse, which apply_inverse_epochs checks for
+    epochs.add_proj(inverse_operator['projs'],verbose=False)
+    pick_ori = 'vector' if free_ori else ori
+    stc = mne.minimum_norm.apply_inverse_epochs(epochs,inverse_operator,lambda2,method,pick_ori=pick_ori,nave=nave,verbose=False)[0]
+    return stc.data.reshape(-1,len(ch_names)), list(ch_names)
+
+def prepare_source_kernel(inverse_operator,method='sLORETA',lambda2=None,snr=3.0,ori='normal',nave=1,roi=SOURCE_ROI,roi_mode=SOURCE_ROI_MODE) -> dict:
+    """Assembles the imaging kernel used by source_reconstruction once, so band power
+    can be computed from sensor data without building SourceEstimates. With a roi, the
+    kernel only keeps the rows of the sources in those labels."""
+    if lambda2 is None:
+        lambda2 = 1.0 / snr ** 2
+    free_ori = not (mne.forward.is_fixed_orient(inverse_operator) or ori == 'normal')
+    if _assemble_kernel is None:
+        K, kernel_ch_names = inverse_kernel_from_epochs(inverse_operator,method,lambda2,ori,nave,free_ori)
+        ch_names, sel, noise_norm = kernel_ch_names, range(len(kernel_ch_names)), None
+    else:
+        inv = mne.minimum_norm.prepare_inverse_operator(inverse_operator,nave,lambda2,method,verbose=False)
+        K, noise_norm, _, _ = _assemble_kernel(inv, None, method, ori, verbose=False)
+        ch_names = inv['info']['ch_names']
+        sel = _pick_channels_inverse_operator(ch_names, inv)
+
+    if not free_ori and noise_norm is not None:
+        K = K * noise_norm
+        noise_norm = None
+    if noise_norm is not None:
+        noise_norm = noise_norm.ravel()
+
+    n_sources = len(K)//3 if free_ori else len(K)
+    sources, projection = None, None
+    if roi is not None:
+        sources, projection = roi_sources(inverse_operator,roi,roi_mode)
+        rows = (3*sources[:,None]+np.arange(3)).ravel() if free_ori else sources
+        K = K[rows]
+        if noise_norm is not None:
+            noise_norm = noise_norm[sources]
+    return {
+        'K': K,
+        'noise_norm': noise_norm,
+        'free_ori': free_ori,
+        'ch_names': [ch_names[i] for i in sel],
+        'n_sources': n_sources,
+        'roi_sources': sources,
+        'roi_projection': projection,
+        'roi': source_roi(roi,roi_mode),
+    }
+
+def project_source_features(features,kernel,n_bands,features_roi=None):
+    """Reduces features computed with the full kernel to the roi of kernel. features_roi
+    is the source_roi the features were computed with. Features of the kernel's own roi
+    are returned as they are, features of any other roi give None."""
+    features = np.asarray(features).reshape(len(features),-1)
+    n_roi = len(kernel['K'])//3 if kernel['free_ori'] else len(kernel['K'])
+    if kernel.get('roi_projection') is not None:
+        n_roi = len(kernel['roi_projection'])
+    if features_roi is not None:
+        if features_roi != kernel.get('roi') or features.shape[1] != n_bands*n_roi:
+            return None
+        return features
+    if features.shape[1] != n_bands*kernel['n_sources']:
+        return None
+    if kernel.get('roi_sources') is None:
+        return features
+    power = features.reshape(len(features),n_bands,kernel['n_sources'])[:,:,kernel['roi_sources']]
+    if kernel['roi_projection'] is not None:
+        power = power @ kernel['roi_projection'].T
+    return power.reshape(len(features),-1)
+
+def source_band_power(kernel,data) -> np.ndarray:
+    """Mean source power over time, i.e. np.mean(np.abs(stc.data)**2,axis=1), for
+    data of shape (n_epochs, n_channels, n_times) ordered as kernel['ch_names']."""
+    K = kernel['K']
+    n_times = data.shape[-1]
+    if n_times > data.shape[-2]:
+        # diag(K C K^T) with the channel covariance C is cheaper than projecting every sample
+        C = np.matmul(data, data.transpose(0,2,1)) / n_times
+        power = np.sum(np.matmul(K, C) * K, axis=2)
+    else:
+        power = np.mean(np.matmul(K, data)**2, axis=2)
+    if kernel['free_ori']:
+        power = power.reshape(len(data), -1, 3).sum(axis=2)
+        if kernel['noise_norm'] is not None:
+            power *= kernel['noise_norm']**2
+    if kernel.get('roi_projection') is not None:
+        power = power @ kernel['roi_projection'].T
+    return power
+
+class StreamingPreprocessor:
+    """Causal counterpart of the filtering in sample_to_epoch. Band-pass and notch
+    filter state is kept between chunks and every sample is re-referenced to the
+    average as it arrives, so a trial window is ready when the marker window closes."""
+
+    def __init__(self, n_channels, sfreq, f_low=F_LOW, f_high=F_HIGH, f_notch=F_NOTCH, notch_bandwidth=2, order=4):
+        band_pass = scipy.signal.butter(order, [f_low, f_high], btype='bandpass', fs=sfreq, output='sos')
+        notch = scipy.signal.tf2sos(*scipy.signal.iirnotch(f_notch, f_notch/notch_bandwidth, fs=sfreq))
+        self.sos = np.vstack([band_pass, notch])
+        self.zi_step = scipy.signal.sosfilt_zi(self.sos)[:, None, :]
+        self.zi = None
+
+    def process(self, chunk) -> np.ndarray:
+        """Filters a (n_channels, n_samples) chunk and returns it average referenced."""
+        if self.zi is None:
+            # Start in steady state for the first sample to avoid a large onset transient
+            self.zi = self.zi_step * chunk[None, :, :1]
+        filtered, self.zi = scipy.signal.sosfilt(self.sos, chunk, axis=-1, zi=self.zi)
+        return filtered - filtered.mean(axis=0, keepdims=True)
+
+def apple_event(apple_position,event_timestep):
+    if apple_position>SCREEN_WIDTH/2:
+        event_id = {"MI_right": 1}
+        event = np.array([[event_timestep,0,1]])
+    else:
+        event_id = {"MI_left": 0}
+        event = np.array([[event_timestep,0,0]])
+    return event, event_id
+
+def stream_to_epoch(sample,timestamps,inlet_info,apple_position) -> mne.Epochs:
+    """Cuts the epoch of sample_to_epoch out of data that the StreamingPreprocessor
+    has already filtered and re-referenced."""
+    sfreq = inlet_info['sfreq']
+    event_timestep = int(BEFORE_MARKER_TIME*sfreq)-1
+    event, event_id = apple_event(apple_position,event_timestep)
+
+    first = int(round((-BEFORE_MARKER_TIME+0.05)*sfreq))
+    last = int(round(MARKER_TIME*sfreq))
+    data = sample[:, event_timestep+first:event_timestep+last+1]
+
+    epochs = mne.EpochsArray(data[None], inlet_info, event, tmin=first/sfreq, event_id=event_id, baseline=None, verbose=False)
+    # The data is already referenced; the projector keeps info identical to sample_to_epoch
+    epochs.set_eeg_reference('average', projection=True, verbose=False)
+    epochs.apply_proj(verbose=False)
+    return epochs
+
 def sample_to_epoch(sample,timestamps,inlet_info,apple_position) -> mne.Epochs:
 
     raw = mne.io.RawArray(sample, inlet_info,verbose=False)    
@@ -28,12 +212,7 @@ def sample_to_epoch(sample,timestamps,inlet_info,apple_position) -> mne.Epochs:
     event_timestep = int(BEFORE_MARKER_TIME*inlet_info['sfreq'])-1
     print(event_timestep)
 
-    if apple_position>SCREEN_WIDTH/2:
-        event_id = {"MI_right": 1}
-        event = np.array([[event_timestep,0,1]])
-    else:
-        event_id = {"MI_left": 0}
-        event = np.array([[event_timestep,0,0]])
+    event, event_id = apple_event(apple_position,event_timestep)
     
     tmin = -BEFORE_MARKER_TIME+0.05 
     tmax = MARKER_TIME 
@@ -52,37 +231,84 @@ def sample_to_epoch(sample,timestamps,inlet_info,apple_position) -> mne.Epochs:
 
     return epochs
 
-def create_inverse_operator(info) -> mne.minimum_norm.InverseOperator:
+def inverse_operator_cache_key(info,spacing='oct6',loose=0.2,depth=0.8):
+    """Key built from everything the forward and inverse solutions depend on."""
+    positions = np.array([ch['loc'][:3] for ch in info['chs']])
+    projs = [(p['desc'], p['active'], p['data']['data']) for p in info['projs']]
+    return hash_key(info['ch_names'], positions, info['sfreq'], projs, loose, depth, spacing)
+
+def _cached_fif(key, suffix, read, write, make):
+    """Reads a cached fif entry or computes it and stores it atomically."""
+    path = cache_lookup(INVERSE_CACHE_DIR, key, suffix)
+    if path is not None:
+        return read(path, verbose=False)
+    obj = make()
+    path = cache_path(INVERSE_CACHE_DIR, key, suffix)
+    tmp_path = cache_path(INVERSE_CACHE_DIR, f"{key}.{os.getpid()}.tmp", suffix)
+    write(tmp_path, obj, overwrite=True, verbose=False)
+    os.replace(tmp_path, path)
+    evict_cache(INVERSE_CACHE_DIR, INVERSE_CACHE_MAX_BYTES)
+    return obj
+
+def create_inverse_operator(info,spacing='oct6',loose=0.2,depth=0.8,use_cache=True) -> mne.minimum_norm.InverseOperator:
     """This function is strongly based on the function generic_inverse created by
-    Viktor Naas. Link: https://github.com/wavesresearch/double_step_optimization/blob/2686d518257a58023d16135d1a1c1b06cdff30ab/project_utils/utils.py#L325"""
+    Viktor Naas. Link: https://github.com/wavesresearch/double_step_optimization/blob/2686d518257a58023d16135d1a1c1b06cdff30ab/project_utils/utils.py#L325
+
+    Source spaces, forward solutions and inverse operators are cached in
+    INVERSE_CACHE_DIR, so a headset that was seen before loads its operator from disk.
+    Run `python cache.py clear inverse` to invalidate the cache."""
 
-    subjects_dir = os.getcwd()+'/mne_data/MNE-sample-data/subjects'
+    subjects_dir = fsaverage_subjects_dir()
     mne.set_config('SUBJECTS_DIR',subjects_dir)
+
+    inverse_key = inverse_operator_cache_key(info,spacing,loose,depth)
+    if use_cache:
+        path = cache_lookup(INVERSE_CACHE_DIR, inverse_key, '-inv.fif')
+        if path is not None:
+            return mne.minimum_norm.read_inverse_operator(path, verbose=False)
+
     mne.datasets.fetch_fsaverage(subjects_dir=subjects_dir,verbose=False)
 
-    noise_cov = mne.make_ad_hoc_cov(info,verbose = False)
-    bem = mne.read_bem_solution(f'{subjects_dir}/fsaverage/bem/fsaverage-5120-5120-5120-bem-sol.fif',verbose=False)
-    src = mne.setup_source_space('fsaverage',spacing='oct6',add_dist='patch',subjects_dir=subjects_dir,verbose=False)
-
-    fwd = mne.make_forward_solution(
-        info,
-        trans="fsaverage",
-        src=src,
-        bem=bem,
-        meg=False,
-        eeg=True,
-        mindist=5.0,
-        n_jobs=None,
-        verbose=False
-    )
-    inverse_operator = mne.minimum_norm.make_inverse_operator(
-        info,
-        fwd,
-        noise_cov,
-        loose = 0.2,
-        depth = 0.8,
-        verbose=False
-    )
+    def make_src():
+        return mne.setup_source_space('fsaverage',spacing=spacing,add_dist='patch',subjects_dir=subjects_dir,verbose=False)
+
+    def make_fwd():
+        bem = mne.read_bem_solution(f'{subjects_dir}/fsaverage/bem/fsaverage-5120-5120-5120-bem-sol.fif',verbose=False)
+        return mne.make_forward_solution(
+            info,
+            trans="fsaverage",
+            src=src,
+            bem=bem,
+            meg=False,
+            eeg=True,
+            mindist=5.0,
+            n_jobs=None,
+            verbose=False
+        )
+
+    def make_inv():
+        noise_cov = mne.make_ad_hoc_cov(info,verbose = False)
+        return mne.minimum_norm.make_inverse_operator(
+            info,
+            fwd,
+            noise_cov,
+            loose = loose,
+            depth = depth,
+            verbose=False
+        )
+
+    if not use_cache:
+        src = make_src()
+        fwd = make_fwd()
+        return make_inv()
+
+    positions = np.array([ch['loc'][:3] for ch in info['chs']])
+    src = _cached_fif(hash_key('fsaverage', spacing), '-src.fif',
+                      mne.read_source_spaces, mne.write_source_spaces, make_src)
+    fwd = _cached_fif(hash_key('fsaverage', spacing, info['ch_names'], positions), '-fwd.fif',
+                      mne.read_forward_solution, mne.write_forward_solution, make_fwd)
+    inverse_operator = _cached_fif(inverse_key, '-inv.fif',
+                      mne.minimum_norm.read_inverse_operator, mne.minimum_norm.write_inverse_operator, make_inv)
     return inverse_operator
 
 def preprocess_giga_data(epochs_left,epochs_right):
@@ -92,18 +318,156 @@ def preprocess_giga_data(epochs_left,epochs_right):
     info = epochs.info
     return epochs,info
 
-def extract_features(epochs,inverse_operator,tmin=-0.5,tmax=1.0,decimation_factor=1,frequencies=F_BANDS):
+@functools.lru_cache(maxsize=16)
+def design_filter_bank(sfreq,frequencies) -> np.ndarray:
+    """Designs the same zero-phase FIR band-pass filters as Epochs.filter for every band
+    and centers them in a (n_bands, n_taps) array."""
+    filters = [
+        mne.filter.create_filter(None,sfreq,f_low,f_high,method='fir',phase='zero',fir_window='hamming',fir_design='firwin',verbose=False)
+        for f_low,f_high in frequencies
+    ]
+    n_taps = max(len(h) for h in filters)
+    bank = np.zeros((len(filters),n_taps))
+    for i,h in enumerate(filters):
+        start = (n_taps-len(h))//2
+        bank[i,start:start+len(h)] = h
+    bank.flags.writeable = False
+    return bank
+
+@functools.lru_cache(maxsize=16)
+def _filter_bank_spectrum(sfreq,frequencies,n_fft) -> np.ndarray:
+    spectrum = scipy.fft.rfft(design_filter_bank(sfreq,frequencies),n_fft,axis=-1)
+    spectrum.flags.writeable = False
+    return spectrum
+
+def apply_filter_bank(data,sfreq,frequencies=F_BANDS) -> np.ndarray:
+    """Filters data of shape (..., n_times) with every band in a single FFT pass and
+    returns an array of shape (n_bands, ..., n_times). Like Epochs.filter, the signal
+    is edge padded before the zero-phase convolution."""
+    frequencies = tuple(tuple(band) for band in frequencies)
+    n_taps = design_filter_bank(sfreq,frequencies).shape[1]
+    n_times = data.shape[-1]
+    n_edge = max(min(n_taps,n_times)-1,0)
+    padded = np.pad(data,[(0,0)]*(data.ndim-1)+[(n_edge,n_edge)],mode='edge')
+    n_fft = scipy.fft.next_fast_len(padded.shape[-1]+n_taps-1,real=True)
+
+    spectrum = _filter_bank_spectrum(sfreq,frequencies,n_fft)
+    spectrum = spectrum.reshape((len(frequencies),)+(1,)*(data.ndim-1)+(spectrum.shape[-1],))
+    filtered = scipy.fft.irfft(scipy.fft.rfft(padded,n_fft,axis=-1)*spectrum,n_fft,axis=-1)
+    start = n_edge+(n_taps-1)//2
+    return filtered[...,start:start+n_times]
+
+def filter_bank_epochs(data,times,sfreq,tmin,tmax,decimation_factor=1,frequencies=F_BANDS) -> np.ndarray:
+    """Band-passes, decimates and crops epoch data of shape (n_epochs, n_channels, n_times)
+    the way filter().decimate().crop() does, without copying any Epochs."""
+    filtered = apply_filter_bank(data,sfreq,frequencies)
+
+    # Decimate so the sample at time zero is kept, like Epochs.decimate
+    start = int(round(-times[0]*sfreq)) % decimation_factor
+    filtered = filtered[...,start::decimation_factor]
+    times = times[start::decimation_factor]
+    sfreq = sfreq/decimation_factor
+
+    # Crop with the same sample rounding as Epochs.crop
+    mask = (times >= round(tmin*sfreq)/sfreq-0.5/sfreq) & (times <= round(tmax*sfreq)/sfreq+0.5/sfreq)
+    return filtered[...,mask]
+
+def resolve_feature_engine(n_channels,engine=FEATURE_ENGINE):
+    if engine == "auto":
+        return "sloreta" if n_channels >= SOURCE_MIN_CHANNELS else "csp"
+    return engine
+
+def sensor_band_features(band_data,engine) -> np.ndarray:
+    """Features of filter bank data of shape (n_bands, n_epochs, n_channels, n_times)
+    without source imaging. "logvar" gives the log-variance of every band and channel,
+    "csp" the upper triangle of every band's channel covariance for FilterBankCSP."""
+    if engine == "logvar":
+        X = np.log(np.mean(band_data**2,axis=-1))
+    else:
+        C = np.matmul(band_data,band_data.swapaxes(-1,-2))/band_data.shape[-1]
+        rows, cols = np.triu_indices(band_data.shape[-2])
+        X = C[...,rows,cols]
+    return np.concatenate(list(X),axis=1)
+
+def extract_array_features(data,times,sfreq,kernel,tmin=-0.5,tmax=1.0,decimation_factor=1,frequencies=F_BANDS):
+    """Features for data of shape (n_epochs, n_channels, n_times) ordered as kernel['ch_names']."""
+    with span("filter_bank"):
+        band_data = filter_bank_epochs(data,times,sfreq,tmin,tmax,decimation_factor,frequencies)
     X = []
-    for f_low,f_high in frequencies:
-        epoch_filtered = epochs.copy().filter(f_low,f_high,verbose=False)
-        epoch_filtered = epoch_filtered.decimate(decimation_factor,verbose=False)
-        epoch_filtered = epoch_filtered.crop(tmin=tmin,tmax=tmax,verbose=False)
-        stcs = source_reconstruction(epoch_filtered,inverse_operator,method = 'sLORETA',snr=3.0)
-        x = np.array([np.mean(np.abs(stc.data)**2,axis=1) for stc in stcs])
-        X.append(x)
+    for (f_low,f_high),x in zip(frequencies,band_data):
+        with span(f"band_power_{f_low}-{f_high}Hz"):
+            X.append(source_band_power(kernel,x))
     X = np.concatenate(X,axis=1)
     return X
 
- 
+def extract_data_features(data,ch_names,times,sfreq,kernel,tmin=-0.5,tmax=1.0,decimation_factor=1,frequencies=F_BANDS,engine="sloreta"):
+    """extract_features for data of shape (n_epochs, n_channels, n_times) with channels ch_names."""
+    if engine != "sloreta":
+        # Sensor space engines use every channel and need no inverse operator
+        with span("filter_bank"):
+            band_data = filter_bank_epochs(data,times,sfreq,tmin,tmax,decimation_factor,frequencies)
+        with span(f"{engine}_features"):
+            return sensor_band_features(band_data,engine)
+    picks = [ch_names.index(ch) for ch in kernel['ch_names']]
+    return extract_array_features(data[:,picks],times,sfreq,kernel,tmin,tmax,decimation_factor,frequencies)
 
- 
\ No newline at end of file
+def extract_features(epochs,inverse_operator,tmin=-0.5,tmax=1.0,decimation_factor=1,frequencies=F_BANDS,kernel=None,engine="sloreta"):
+    if kernel is None and engine == "sloreta":
+        kernel = prepare_source_kernel(inverse_operator,method='sLORETA',snr=3.0)
+    return extract_data_features(epochs.get_data(),epochs.ch_names,epochs.times,epochs.info['sfreq'],kernel,tmin,tmax,decimation_factor,frequencies,engine)
+
+def kernel_cache_key(kernel):
+    return hash_key(kernel['K'], kernel['noise_norm'], kernel['free_ori'], kernel['ch_names'], kernel.get('roi_projection'))
+
+def extract_features_cached(epochs,inverse_operator,tmin=-0.5,tmax=1.0,decimation_factor=1,frequencies=F_BANDS,kernel=None):
+    """extract_features memoized on disk. Every band is stored as its own block in
+    FEATURE_CACHE_DIR, keyed by the epoch data, the source kernel and the parameters,
+    so changing one band or the crop window only recomputes the blocks that changed."""
+    if kernel is None:
+        kernel = prepare_source_kernel(inverse_operator,method='sLORETA',snr=3.0)
+    picks = [epochs.ch_names.index(ch) for ch in kernel['ch_names']]
+    data = epochs.get_data()[:,picks]
+    sfreq = epochs.info['sfreq']
+    data_key = hash_key(data, epochs.times, sfreq, kernel_cache_key(kernel), tmin, tmax, decimation_factor)
+
+    keys = [hash_key(data_key, tuple(band)) for band in frequencies]
+    blocks = [cache_lookup(FEATURE_CACHE_DIR, key, '.npy') for key in keys]
+    missing = [i for i, path in enumerate(blocks) if path is None]
+    if missing:
+        band_data = filter_bank_epochs(data,epochs.times,sfreq,tmin,tmax,decimation_factor,[frequencies[i] for i in missing])
+        for i, x in zip(missing, band_data):
+            block = source_band_power(kernel,x)
+            tmp_path = cache_path(FEATURE_CACHE_DIR, f"{keys[i]}.{os.getpid()}.tmp", '.npy')
+            np.save(tmp_path, block)
+            os.replace(tmp_path, cache_path(FEATURE_CACHE_DIR, keys[i], '.npy'))
+            blocks[i] = block
+        evict_cache(FEATURE_CACHE_DIR, FEATURE_CACHE_MAX_BYTES)
+    X = [np.load(block) if isinstance(block, str) else block for block in blocks]
+    return np.concatenate(X,axis=1)
+
+# State of the extract_features_parallel worker processes, set once per worker
+_worker_kernel = None
+_worker_epochs = None
+
+def _init_feature_worker(kernel,epochs):
+    global _worker_kernel, _worker_epochs
+    _worker_kernel = kernel
+    _worker_epochs = epochs
+
+def _extract_features_worker(index,tmin,tmax,decimation_factor,frequencies,engine):
+    return extract_features(_worker_epochs[index],None,tmin,tmax,decimation_factor,frequencies,kernel=_worker_kernel,engine=engine)
+
+def extract_features_parallel(epochs,kernel,tmin=-0.5,tmax=1.0,decimation_factor=1,frequencies=F_BANDS,n_jobs=None,engine="sloreta"):
+    """Runs extract_features on every element of epochs in a process pool and returns
+    the results in order. The kernel and epochs are sent to each worker once."""
+    n_jobs = min(n_jobs or os.cpu_count(), len(epochs))
+    X = [None]*len(epochs)
+    with ProcessPoolExecutor(n_jobs,initializer=_init_feature_worker,initargs=(kernel,epochs)) as executor:
+        futures = {
+            executor.submit(_extract_features_worker,i,tmin,tmax,decimation_factor,frequencies,engine): i
+            for i in range(len(epochs))
+        }
+        for done, future in enumerate(as_completed(futures),1):
+            X[futures[future]] = future.result()
+            print(f"Extracting features... {done}/{len(epochs)}")
+    return X
@@ -0,0 +1,149 @@
+import argparse
+import glob
+import json
+import os
+import time
+import numpy as np
+from constants import *
+
+RESULTS_LOG = "test_results.jsonl"
+
+def subject_folder(subject_number):
+    return f"data/s{str(subject_number).zfill(2)}"
+
+def _append_lines(file_path, lines):
+    # Start on a fresh line if a crash left the last row unfinished
+    if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
+        with open(file_path, "rb") as file:
+            file.seek(-1, os.SEEK_END)
+            if file.read(1) != b"\n":
+                lines = "\n" + lines
+    with open(file_path, "a") as file:
+        file.write(lines)
+        file.flush()
+        os.fsync(file.fileno())
+
+def append_results(subject_number, run_id, trials, predictions, labels):
+    """Appends one row per trial to the subject's results log. Rows are only ever
+    appended, so a crash can at worst cut the last line short."""
+    folder = subject_folder(subject_number)
+    os.makedirs(folder, exist_ok=True)
+    migrate_results_json(folder)
+
+    timestamp = time.strftime('%Y-%m-%dT%H:%M:%S')
+    lines = "".join(
+        json.dumps({
+            "subject": int(subject_number),
+            "run": run_id,
+            "trial": int(trial),
+            "prediction": int(prediction),
+            "label": int(label),
+            "timestamp": timestamp,
+        }) + "\n"
+        for trial, prediction, label in zip(trials, predictions, labels)
+    )
+    _append_lines(os.path.join(folder, RESULTS_LOG), lines)
+
+def append_result(subject_number, run_id, trial, prediction, label):
+    append_results(subject_number, run_id, [trial], [prediction], [label])
+
+def read_results(subject_number=None):
+    """All logged trials of one subject, or of every subject when subject_number is None."""
+    if subject_number is None:
+        files = sorted(glob.glob(f"data/s*/{RESULTS_LOG}"))
+    else:
+        files = [os.path.join(subject_folder(subject_number), RESULTS_LOG)]
+    rows = []
+    for file_path in files:
+        if not os.path.exists(file_path):
+            continue
+        with open(file_path, "r") as file:
+            for line in file:
+                try:
+                    rows.append(json.loads(line))
+                except json.JSONDecodeError:
+                    pass # Line cut short by a crash
+    return rows
+
+def compute_metrics(predictions, labels):
+    predictions = np.asarray(predictions).ravel()
+    labels = np.asarray(labels).ravel()
+    tp = int(np.sum((predictions == 1) & (labels == 1)))
+    tn = int(np.sum((predictions == 0) & (labels == 0)))
+    fp = int(np.sum((predictions == 1) & (labels == 0)))
+    fn = int(np.sum((predictions == 0) & (labels == 1)))
+    precision = tp / (tp + fp) if (tp + fp) > 0 else 0
+    right_recall = tp / (tp + fn) if (tp + fn) > 0 else 0 # How well right (1) is predicted
+    left_recall = tn / (tn + fp) if (tn + fp) > 0 else 0 # How well left (0) is predicted
+    return {
+        "n_trials": len(labels),
+        "score": tp + tn,
+        "accuracy": (tp + tn) / len(labels) if len(labels) > 0 else 0,
+        "right_recall": right_recall,
+        "left_recall": left_recall,
+        "precision": precision,
+        "f1": 2 * precision * right_recall / (precision + right_recall) if (precision + right_recall) > 0 else 0,
+    }
+
+def summarize_results(rows, by=("subject", "run")):
+    """Metrics per group of rows, e.g. per run, per subject (by=("subject",)) or over all rows (by=())."""
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(row[key] for key in by), []).append(row)
+    return {
+        key: compute_metrics([row["prediction"] for row in group], [row["label"] for row in group])
+        for key, group in sorted(groups.items(), key=lambda item: str(item[0]))
+    }
+
+def migrate_results_json(folder):
+    """Converts the test_results.json written by older versions into log rows, once."""
+    old_path = os.path.join(folder, "test_results.json")
+    if not os.path.exists(old_path):
+        return
+    try:
+        with open(old_path, "r") as file:
+            results = json.load(file)
+    except json.JSONDecodeError:
+        results = {}
+
+    subject_number = int(os.path.basename(folder)[1:])
+    timestamp = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(os.path.getmtime(old_path)))
+    tests = sorted(results.items(), key=lambda item: int(item[0].split("_")[-1]))
+    lines = "".join(
+        json.dumps({
+            "subject": subject_number,
+            "run": test_key,
+            "trial": trial,
+            "prediction": int(prediction),
+            "label": int(label),
+            "timestamp": timestamp,
+        }) + "\n"
+        for test_key, test in tests
+        for trial, (prediction, label) in enumerate(zip(test["predictions"], test["y_test"]))
+    )
+    _append_lines(os.path.join(folder, RESULTS_LOG), lines)
+    os.replace(old_path, old_path + ".migrated")
+    print(f"Migrated {len(tests)} tests from {old_path}")
+
+def print_summary(summary, by):
+    header = "".join(f"{key:<22}" for key in by)
+    print(f"{header}{'trials':>8}{'accuracy':>10}{'right_rec':>11}{'left_rec':>10}{'f1':>8}")
+    for key, metrics in summary.items():
+        group = "".join(f"{str(value):<22}" for value in key)
+        print(f"{group}{metrics['n_trials']:>8}{metrics['accuracy']:>10.2%}{metrics['right_recall']:>11.2%}{metrics['left_recall']:>10.2%}{metrics['f1']:>8.2f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the test results logs")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    summary_parser = subparsers.add_parser("summary", help="Accuracy, recall and F1 per run, subject or overall")
+    summary_parser.add_argument("--subject", type=int, default=None)
+    summary_parser.add_argument("--by", choices=["run", "subject", "all"], default="run")
+    subparsers.add_parser("migrate", help="Convert every data/sNN/test_results.json into the log")
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        for folder in sorted(glob.glob("data/s*")):
+            migrate_results_json(folder)
+    else:
+        by = {"run": ("subject", "run"), "subject": ("subject",), "all": ()}[args.by]
+        print_summary(summarize_results(read_results(args.subject), by), by)
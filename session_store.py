@@ -0,0 +1,172 @@
+import json
+import os
+import time
+import mne
+import numpy as np
+from constants import *
+
+# One record per trial, appended after the trial's data so a crash never indexes missing data
+INDEX_DTYPE = np.dtype([
+    ('offset', '<i8'),      # Offset of the trial in the trials file, in samples
+    ('n_times', '<i8'),
+    ('label', '<i8'),
+    ('prediction', '<i8'),  # -1 when the trial was not classified
+    ('time', '<f8'),        # Wall clock time the trial was stored
+])
+
+def session_files(stem):
+    return {
+        "meta": f"{stem}_meta.json",
+        "info": f"{stem}_info.fif",
+        "trials": f"{stem}_trials.bin",
+        "timestamps": f"{stem}_timestamps.bin",
+        "features": f"{stem}_features.bin",
+        "index": f"{stem}_index.bin",
+    }
+
+class SessionWriter:
+    """Appends every trial of a session to disk as soon as it is complete. Trial data,
+    timestamps and features go to flat float64 files that SessionReader memory-maps,
+    and labels and predictions to a fixed size index record per trial."""
+
+    def __init__(self, stem, info, tmin, event_id, feature_engine="sloreta", preprocessing="offline", source_roi=None):
+        os.makedirs(os.path.dirname(stem) or ".", exist_ok=True)
+        self.stem = stem
+        self.files = session_files(stem)
+        self.n_channels = len(info['ch_names'])
+        self.offset = 0
+        self.n_features = None
+
+        mne.io.write_info(self.files["info"], info)
+        self.meta = {
+            "ch_names": info['ch_names'],
+            "sfreq": info['sfreq'],
+            "tmin": tmin,
+            "event_id": event_id,
+            "n_features": None,
+            "feature_engine": feature_engine,
+            "preprocessing": preprocessing,
+            "source_roi": source_roi, # See preprocessing.source_roi, None for every source
+            "created": time.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        self.write_meta()
+        self.trials = open(self.files["trials"], "ab")
+        self.timestamps = open(self.files["timestamps"], "ab")
+        self.features = open(self.files["features"], "ab")
+        self.index = open(self.files["index"], "ab")
+
+    def write_meta(self):
+        with open(self.files["meta"] + ".tmp", "w") as file:
+            json.dump(self.meta, file, indent=4)
+        os.replace(self.files["meta"] + ".tmp", self.files["meta"])
+
+    def append_trial(self, data, timestamps, label, prediction=None):
+        """Stores one trial of shape (n_channels, n_times) with the LSL timestamps of its samples."""
+        data = np.ascontiguousarray(data, dtype=np.float64)
+        self.trials.write(data.tobytes())
+        self.timestamps.write(np.asarray(timestamps, dtype=np.float64).tobytes())
+        self.trials.flush()
+        self.timestamps.flush()
+
+        record = np.array([(self.offset, data.shape[1], label, -1 if prediction is None else prediction, time.time())], dtype=INDEX_DTYPE)
+        self.index.write(record.tobytes())
+        self.index.flush()
+        self.offset += data.shape[1]
+
+    def append_features(self, features):
+        """Stores the feature vector of the next trial that has none yet."""
+        features = np.asarray(features, dtype=np.float64).ravel()
+        if self.n_features is None:
+            self.n_features = len(features)
+            self.meta["n_features"] = self.n_features
+            self.write_meta()
+        self.features.write(features.tobytes())
+        self.features.flush()
+
+    def close(self):
+        for file in (self.trials, self.timestamps, self.features, self.index):
+            file.close()
+
+class SessionReader:
+    """Lazy, memory-mapped view of a session written by SessionWriter. Only the index
+    and meta data are read up front; trials are read when they are accessed."""
+
+    def __init__(self, stem):
+        if stem.endswith("_meta.json"):
+            stem = stem[:-len("_meta.json")]
+        self.stem = stem
+        self.files = session_files(stem)
+        with open(self.files["meta"], "r") as file:
+            self.meta = json.load(file)
+        self.n_channels = len(self.meta["ch_names"])
+        self._index = None
+        self._info = None
+
+    def __getstate__(self):
+        # Memory maps are reopened in the receiving process
+        return {"stem": self.stem}
+
+    def __setstate__(self, state):
+        self.__init__(state["stem"])
+
+    def _memmap(self, name):
+        path = self.files[name]
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return np.zeros(0)
+        return np.memmap(path, dtype=np.float64, mode='r')
+
+    @property
+    def index(self):
+        if self._index is None:
+            size = os.path.getsize(self.files["index"])
+            # A record cut short by a crash is ignored
+            self._index = np.fromfile(self.files["index"], dtype=INDEX_DTYPE, count=size//INDEX_DTYPE.itemsize)
+        return self._index
+
+    @property
+    def info(self):
+        if self._info is None:
+            self._info = mne.io.read_info(self.files["info"], verbose=False)
+        return self._info
+
+    @property
+    def labels(self):
+        return self.index['label']
+
+    @property
+    def predictions(self):
+        return self.index['prediction']
+
+    def __len__(self):
+        return len(self.index)
+
+    def trial_data(self, i):
+        record = self.index[i]
+        start = record['offset']*self.n_channels
+        data = self._memmap("trials")[start:start+record['n_times']*self.n_channels]
+        return data.reshape(self.n_channels, record['n_times'])
+
+    def trial_timestamps(self, i):
+        record = self.index[i]
+        return self._memmap("timestamps")[record['offset']:record['offset']+record['n_times']]
+
+    def __getitem__(self, i):
+        """The trial as a single epoch, like the ones the game creates."""
+        label = int(self.labels[i])
+        event_id = {name: value for name, value in self.meta["event_id"].items() if value == label}
+        event = np.array([[0, 0, label]])
+        return mne.EpochsArray(np.array(self.trial_data(i))[None], self.info, event, tmin=self.meta["tmin"], event_id=event_id, baseline=None, verbose=False)
+
+    def has_features(self):
+        return self.meta["n_features"] is not None and len(self.features()) == len(self)
+
+    def features(self):
+        """Memory-mapped (n_trials, n_features) feature matrix."""
+        if self.meta["n_features"] is None:
+            return np.zeros((0, 0))
+        features = self._memmap("features")
+        n_rows = len(features)//self.meta["n_features"]
+        return features[:n_rows*self.meta["n_features"]].reshape(n_rows, self.meta["n_features"])
+
+    def data_files(self):
+        return list(self.files.values())
@@ -0,0 +1,154 @@
+import argparse
+import random
+import threading
+import time
+import numpy as np
+import pylsl
+from constants import *
+
+def hemisphere(ch_name):
+    """-1 for left hemisphere electrodes (odd numbers), 1 for right (even), 0 for midline."""
+    if ch_name[-1] in "zZ":
+        return 0
+    return 1 if int(ch_name[-1]) % 2 == 0 else -1
+
+class SyntheticMIOutlet:
+    """LSL outlet that stands in for the headset. It streams background EEG with mu and
+    beta rhythms over the sensorimotor channels, and desynchronizes them over the
+    hemisphere contralateral to the apple side during the marker window of a trial.
+
+    Stream imperfections can be added: jitter is the standard deviation of the sample
+    timestamps in seconds, out_of_order the probability that a chunk is sent after the
+    next one, and dropout the probability that a chunk is lost."""
+
+    def __init__(self, n_channels=32, sfreq=250., stream_name=STREAM_NAME, chunk_time=0.02,
+                 jitter=0.0, out_of_order=0.0, dropout=0.0, erd=0.6, auto_trials=False, seed=None):
+        self.ch_names = CH_NAMES_BY_COUNT[n_channels]
+        self.n_channels = n_channels
+        self.sfreq = sfreq
+        self.chunk_time = chunk_time
+        self.jitter = jitter
+        self.out_of_order = out_of_order
+        self.dropout = dropout
+        self.erd = erd
+        self.auto_trials = auto_trials
+        self.rng = np.random.default_rng(seed)
+
+        info = pylsl.StreamInfo(stream_name, 'EEG', n_channels, sfreq, pylsl.cf_float32, 'synthetic_mi')
+        channels = info.desc().append_child("channels")
+        for ch_name in self.ch_names:
+            channels.append_child("channel").append_child_value("label", ch_name)
+        self.outlet = pylsl.StreamOutlet(info)
+
+        # Rhythm amplitudes (V): mu and beta over central channels, weaker elsewhere
+        central = np.array(['C' in ch_name for ch_name in self.ch_names])
+        self.mu_amplitude = np.where(central, 10e-6, 3e-6)
+        self.beta_amplitude = np.where(central, 5e-6, 1.5e-6)
+        self.hemispheres = np.array([hemisphere(ch_name) for ch_name in self.ch_names])
+        self.phase = self.rng.uniform(0, 2*np.pi, (2, n_channels))
+        self.noise_state = np.zeros(n_channels)
+
+        self.trial_start = None
+        self.trial_side = None
+        self.sample_count = 0
+        self.held_chunk = None
+        self.running = False
+        self.thread = None
+
+    def start_trial(self, side, start_time=None):
+        """Starts a trial at start_time (local LSL clock); side is 0 for a left and 1 for a right apple."""
+        self.trial_side = side
+        self.trial_start = pylsl.local_clock() if start_time is None else start_time
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._push_loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+    def _gain(self, times):
+        """Rhythm gain per sample and channel, reduced by the ERD during the marker window."""
+        gain = np.ones((len(times), self.n_channels))
+        if self.trial_start is None:
+            return gain
+        in_marker = (times >= self.trial_start+BEFORE_MARKER_TIME) & (times < self.trial_start+BEFORE_MARKER_TIME+MARKER_TIME)
+        # Imagery of the left hand desynchronizes the right hemisphere, and vice versa
+        contralateral = self.hemispheres == (1 if self.trial_side == 0 else -1)
+        gain[np.ix_(in_marker, contralateral)] = 1-self.erd
+        return gain
+
+    def generate(self, times):
+        """Synthetic samples (n_samples x n_channels) for the given sample times."""
+        n = len(times)
+        t = (self.sample_count+np.arange(n))[:, None]/self.sfreq
+        gain = self._gain(times)
+        mu = self.mu_amplitude*np.sin(2*np.pi*10*t+self.phase[0])
+        beta = self.beta_amplitude*np.sin(2*np.pi*20*t+self.phase[1])
+
+        # Brown-ish background noise from a leaky integrator
+        white = self.rng.standard_normal((n, self.n_channels))*2e-6
+        noise = np.empty((n, self.n_channels))
+        state = self.noise_state
+        for i in range(n):
+            state = 0.95*state+white[i]
+            noise[i] = state
+        self.noise_state = state
+        self.sample_count += n
+        return (gain*(mu+beta)+noise).astype(np.float32)
+
+    def _push(self, samples, timestamps):
+        if self.jitter > 0 or self.out_of_order > 0:
+            self.outlet.push_chunk(samples, list(timestamps))
+        else:
+            self.outlet.push_chunk(samples, float(timestamps[-1]))
+
+    def _push_loop(self):
+        start = pylsl.local_clock()
+        next_trial = start
+        while self.running:
+            now = pylsl.local_clock()
+            if self.auto_trials and now >= next_trial:
+                self.start_trial(random.randint(0, 1), next_trial)
+                next_trial += TOTAL_TIME
+
+            n = int((now-start)*self.sfreq)-self.sample_count
+            if n > 0:
+                times = start+(self.sample_count+np.arange(n))/self.sfreq
+                samples = self.generate(times)
+                timestamps = times+self.rng.normal(0, self.jitter, n) if self.jitter > 0 else times
+
+                if self.rng.random() < self.dropout:
+                    pass # The chunk is lost
+                elif self.held_chunk is None and self.rng.random() < self.out_of_order:
+                    self.held_chunk = (samples, timestamps)
+                else:
+                    self._push(samples, timestamps)
+                    if self.held_chunk is not None:
+                        self._push(*self.held_chunk)
+                        self.held_chunk = None
+            time.sleep(self.chunk_time)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stream synthetic motor imagery EEG over LSL")
+    parser.add_argument("--channels", type=int, default=32, choices=sorted(CH_NAMES_BY_COUNT))
+    parser.add_argument("--sfreq", type=float, default=250.)
+    parser.add_argument("--jitter", type=float, default=0.0, help="Timestamp jitter in seconds")
+    parser.add_argument("--out-of-order", type=float, default=0.0, help="Probability of sending a chunk late")
+    parser.add_argument("--dropout", type=float, default=0.0, help="Probability of losing a chunk")
+    parser.add_argument("--erd", type=float, default=0.6, help="Relative mu/beta power drop during imagery")
+    args = parser.parse_args()
+
+    # Without a game to follow, trials with a random apple side start every TOTAL_TIME seconds
+    outlet = SyntheticMIOutlet(args.channels, args.sfreq, jitter=args.jitter, out_of_order=args.out_of_order,
+                               dropout=args.dropout, erd=args.erd, auto_trials=True)
+    outlet.start()
+    print(f"Streaming {args.channels} channels at {args.sfreq} Hz as '{STREAM_NAME}', press Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        outlet.stop()
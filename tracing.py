@@ -0,0 +1,134 @@
+import argparse
+import threading
+import time
+import numpy as np
+from constants import *
+
+# Spans are only recorded between start_trace and stop_trace. Outside of that span()
+# returns a shared object that does nothing, so the instrumented code can stay in place.
+_records = None
+_trace_file = None
+_trace_start = 0.0
+_lock = threading.Lock()
+_context = threading.local() # Trial index and game mode of the current thread
+
+TRACE_HEADER = "trial\tmode\tspan\tstart_ms\tduration_us\n"
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        duration = time.perf_counter()-self.start
+        records = _records
+        if records is not None:
+            records.append((getattr(_context, "trial", -1), getattr(_context, "mode", ""), self.name, self.start, duration))
+        return False
+
+def span(name):
+    """Context manager that records the wall clock time of its block under name."""
+    if _records is None:
+        return _NULL_SPAN
+    return _Span(name)
+
+def set_context(trial=None, mode=None):
+    """Tags the spans recorded from now on by the calling thread."""
+    if trial is not None:
+        _context.trial = trial
+    if mode is not None:
+        _context.mode = mode
+
+def start_trace(path):
+    global _records, _trace_file, _trace_start
+    stop_trace()
+    _trace_file = open(path, "w")
+    _trace_file.write(TRACE_HEADER)
+    _trace_start = time.perf_counter()
+    _records = []
+
+def flush_trace():
+    """Writes the spans recorded so far. Called between trials, never inside a timed block."""
+    if _records is None:
+        return
+    with _lock:
+        # Take the records in place, so spans that end meanwhile on another thread stay queued
+        n = len(_records)
+        records = _records[:n]
+        del _records[:n]
+        _trace_file.write("".join(
+            f"{trial}\t{mode}\t{name}\t{(start-_trace_start)*1000:.3f}\t{duration*1e6:.0f}\n"
+            for trial, mode, name, start, duration in records
+        ))
+        _trace_file.flush()
+
+def stop_trace():
+    global _records, _trace_file
+    if _records is None:
+        return
+    flush_trace()
+    _records = None
+    _trace_file.close()
+    _trace_file = None
+
+def read_trace(path):
+    """Rows of a trace file as (trial, mode, span, start_ms, duration_us) tuples."""
+    rows = []
+    with open(path, "r") as file:
+        next(file, None)
+        for line in file:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) != 5:
+                continue # Line cut short by a crash
+            rows.append((int(fields[0]), fields[1], fields[2], float(fields[3]), float(fields[4])))
+    return rows
+
+def summarize_trace(rows, by_mode=False):
+    """Duration percentiles in ms per span, or per (mode, span) when by_mode is set."""
+    groups = {}
+    for trial, mode, name, start, duration in rows:
+        groups.setdefault((mode, name) if by_mode else (name,), []).append(duration/1000)
+    summary = {}
+    for key, durations in sorted(groups.items()):
+        durations = np.array(durations)
+        summary[key] = {
+            "n": len(durations),
+            "p50": float(np.percentile(durations, 50)),
+            "p90": float(np.percentile(durations, 90)),
+            "p99": float(np.percentile(durations, 99)),
+            "max": float(np.max(durations)),
+        }
+    return summary
+
+def print_trace_summary(summary):
+    print(f"{'span':<32}{'n':>7}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for key, stats in summary.items():
+        name = "/".join(k for k in key if k)
+        print(f"{name:<32}{stats['n']:>7}{stats['p50']:>10.2f}{stats['p90']:>10.2f}{stats['p99']:>10.2f}{stats['max']:>10.2f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize the span traces written during game sessions")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    summary_parser = subparsers.add_parser("summary", help="Duration percentiles per span")
+    summary_parser.add_argument("files", nargs="+", help="Trace files, e.g. data/s01/*_trace.tsv")
+    summary_parser.add_argument("--by-mode", action="store_true", help="Separate the spans of each game mode")
+    args = parser.parse_args()
+
+    rows = [row for path in args.files for row in read_trace(path)]
+    print_trace_summary(summarize_trace(rows, args.by_mode))